@@ -0,0 +1,136 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times each stage of packaging and merging synthetic clients of several sizes.
+
+Each run is a real `hurudist package` and `hurudist merge` in its own process, so the timings are
+those of the stages in the profile report of each command. The package stages overlap in the shared
+pipeline, so the time of a stage includes whatever work of the earlier stages was still running.
+The client is packaged twice, once to a directory and once to a zip file, and only the output
+stage of the zip run is kept.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+import synthetic_client
+
+_hurudist_path = Path(__file__).resolve().parent.parent.joinpath("hurudist")
+
+_stages = ("package_load_ages", "package_list_client", "package_find_pages", "package_find_client",
+           "package_scan_pages", "package_resolve_pfms", "package_prepare", "package_output", "zip_output",
+           "merge_load", "merge_reduce", "merge_save")
+
+def _profile(command, report_path, *args):
+    subprocess.run([sys.executable, str(_hurudist_path), "-q", command, *map(str, args), "--no-cache",
+                    "--profile", str(report_path)], check=True)
+    with report_path.open() as stream:
+        report = json.load(stream)
+    stages = {}
+    for stage in report["stages"]:
+        stages[stage["name"]] = stages.get(stage["name"], 0.0) + stage["wall"]
+    return stages
+
+def run_once(client_path, work_path, jobs, io_jobs, py_exe=None):
+    package_args = ["--jobs", jobs, "--io-jobs", io_jobs]
+    if py_exe is None:
+        package_args.append("--no-pfm-py-dependencies")
+    else:
+        package_args.extend(("--python", py_exe))
+
+    dir_path = work_path.joinpath("package")
+    stages = {}
+    for stage, value in _profile("package", work_path.joinpath("package.json"), client_path, dir_path, *package_args).items():
+        stages[f"package_{stage}"] = value
+    zip_stages = _profile("package", work_path.joinpath("zip.json"), client_path, work_path.joinpath("package.zip"), *package_args)
+    stages["zip_output"] = zip_stages.get("output", 0.0)
+    for stage, value in _profile("merge", work_path.joinpath("merge.json"), dir_path, work_path.joinpath("merged"), "--jobs", jobs).items():
+        stages[f"merge_{stage}"] = value
+    return stages
+
+def run_benchmark(sizes, worker_counts, repeat, io_jobs, py_exe=None):
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as td:
+            client_path = Path(td, "client")
+            print(f"Generating {size} client...")
+            synthetic_client.generate_client(client_path, synthetic_client.presets[size])
+            client_mb = sum(i.stat().st_size for i in client_path.rglob("*") if i.is_file()) / (1024 * 1024)
+
+            for jobs in worker_counts:
+                timings = []
+                for i in range(repeat):
+                    with tempfile.TemporaryDirectory(dir=td) as work_path:
+                        timings.append(run_once(client_path, Path(work_path), jobs, io_jobs, py_exe))
+                # The best run is the least disturbed by everything else on the machine.
+                stages = { stage: min(i.get(stage, 0.0) for i in timings) for stage in _stages }
+                results.append({ "size": size, "jobs": jobs, "client_mb": round(client_mb, 1), "stages": stages })
+                print(f"{size:>6} x {jobs:>2} jobs: " + ", ".join(f"{stage}={stages[stage]:.3f}s" for stage in _stages))
+    return results
+
+def compare(results, baseline, threshold):
+    """Prints the change of each stage against the baseline. Returns False on any regression."""
+    expected = { (i["size"], i["jobs"]): i["stages"] for i in baseline["results"] }
+    ok = True
+    for result in results:
+        baseline_stages = expected.get((result["size"], result["jobs"]))
+        if baseline_stages is None:
+            continue
+        for stage, seconds in result["stages"].items():
+            before = baseline_stages.get(stage)
+            if not before:
+                continue
+            change = (seconds - before) / before
+            # Tiny stages are all noise, so they never count as a regression.
+            regressed = change > threshold and seconds - before > 0.05
+            ok &= not regressed
+            print(f"{result['size']:>6} x {result['jobs']:>2} jobs {stage:>12}: {before:.3f}s -> {seconds:.3f}s "
+                  f"({change:+.0%}){' REGRESSION' if regressed else ''}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=list(synthetic_client.presets.keys()), default=["small", "medium"])
+    parser.add_argument("--jobs", nargs="+", type=int, default=[1, os.cpu_count()], help="worker process counts to try")
+    parser.add_argument("--io-jobs", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--python", type=Path, help="Uru-compatible python interpreter to resolve PythonFileMods with")
+    parser.add_argument("--output", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=int, default=10, metavar="PERCENT",
+                        help="slowdown against the baseline that counts as a regression (default: 10)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.jobs, args.repeat, args.io_jobs, args.python)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4))
+    if args.baseline:
+        with args.baseline.open() as stream:
+            baseline = json.load(stream)
+        if not compare(results, baseline, args.threshold / 100):
+            sys.exit(1)
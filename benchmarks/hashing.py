@@ -0,0 +1,84 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the single-pass asset hasher against submitting one pool job per digest."""
+
+import argparse
+import multiprocessing, multiprocessing.pool
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+import _utils
+
+def generate_files(path, count, max_size):
+    rng = random.Random(0)
+    files = []
+    for i in range(count):
+        file_path = path.joinpath(f"asset{i:04}.bin")
+        file_path.write_bytes(os.urandom(rng.randint(1, max_size)))
+        files.append(file_path)
+    return files
+
+def two_jobs(pool, files):
+    results = [{} for _ in files]
+    def pool_cb(asset_dict, key, value):
+        asset_dict[key] = value
+    for asset_dict, path in zip(results, files):
+        pool.apply_async(_utils.hash_md5, (path,), callback=lambda x, d=asset_dict: pool_cb(d, "hash_md5", x))
+        pool.apply_async(_utils.hash_sha2, (path,), callback=lambda x, d=asset_dict: pool_cb(d, "hash_sha2", x))
+    return results
+
+def single_pass(pool, files):
+    results = [{} for _ in files]
+    for asset_dict, path in zip(results, files):
+        pool.apply_async(_utils.hash_file, (path,), callback=asset_dict.update)
+    return results
+
+def run(func, files, jobs):
+    pool = multiprocessing.pool.Pool(jobs)
+    start = time.perf_counter()
+    results = func(pool, files)
+    pool.close()
+    pool.join()
+    return time.perf_counter() - start, results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=64, help="number of files to hash")
+    parser.add_argument("--max-size", type=int, default=32 * 1024 * 1024, help="largest file size in bytes")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as td:
+        files = generate_files(Path(td), args.count, args.max_size)
+        total_mb = sum(i.stat().st_size for i in files) / (1024 * 1024)
+        print(f"Hashing {len(files)} files ({total_mb:.1f} MiB)")
+
+        for name, func in (("two jobs", two_jobs), ("single pass", single_pass)):
+            timings = []
+            for _ in range(args.repeat):
+                delta, results = run(func, files, args.jobs)
+                timings.append(delta)
+            best = min(timings)
+            print(f"{name:>12}: {best:.3f}s ({total_mb / best:.1f} MiB/s)")
+            if func is single_pass:
+                _, expected = run(two_jobs, files, args.jobs)
+                assert results == expected, "single-pass digests do not match"
@@ -0,0 +1,106 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the memory used by the merge database's asset records against the round-trip YAML
+asset dicts that the database was built from before asset records were introduced.
+"""
+
+import argparse
+import gc
+import hashlib
+from pathlib import Path, PureWindowsPath
+import random
+import sys
+import tracemalloc
+
+from ruamel.yaml import YAML
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+import merge
+
+_categories = ("data", "python", "sdl", "sfx")
+_options = ("pfm", "sound_cache_split", "sound_cache_stereo", "sound_stream")
+
+def generate_bundles(count, num_packages):
+    """Generates the YAML of `num_packages` packages holding `count` assets. Every asset appears
+       in two packages, as though two shards were being merged.
+    """
+    rng = random.Random(0)
+    bundles = [{} for _ in range(num_packages)]
+    for i in range(count):
+        asset_category = rng.choice(_categories)
+        asset_filename = f"Asset{i:06}.dat"
+        lines = [
+            f"    {asset_filename}:",
+            f"      source: {PureWindowsPath(asset_category, asset_filename)}",
+            "      dataset: base",
+            "      distribute: 'true'",
+            f"      size: {rng.randint(1, 1 << 24)}",
+            f"      modify_time: {1600000000 + i}",
+            f"      hash_md5: {hashlib.md5(asset_filename.encode()).hexdigest()}",
+            f"      hash_sha2: {hashlib.sha512(asset_filename.encode()).hexdigest()}",
+        ]
+        if rng.random() < 0.25:
+            lines.append(f"      options: [{rng.choice(_options)}]")
+        for bundle in rng.sample(bundles, 2):
+            bundle.setdefault(asset_category, []).extend(lines)
+    return ["".join(f"{asset_category}:\n" + "".join(f"{i}\n" for i in lines) for asset_category, lines in bundle.items())
+            for bundle in bundles]
+
+def load_dicts(bundles):
+    # The database as it was before asset records were introduced, loaded with the round-trip
+    # loader that was used back then.
+    yaml = YAML()
+    database = {}
+    for i, text in enumerate(bundles):
+        bundle = yaml.load(text)
+        for asset_category, assets in bundle.items():
+            for asset_filename, asset_dict in assets.items():
+                asset_map = database.setdefault((asset_category, asset_filename.lower()), { "filename": asset_filename })
+                asset_map.setdefault("subpackages", set()).add(f"Package{i}")
+                asset_dict["source"] = str(PureWindowsPath(f"Package{i}", asset_dict["source"]))
+                asset_map.setdefault("dicts", []).append(asset_dict)
+    return database
+
+def load_records(bundles):
+    yaml = YAML(typ="safe")
+    database = {}
+    for i, text in enumerate(bundles):
+        merge._add_assets(database, yaml.load(text), "contents.yml", Path(f"Package{i}"), f"Package{i}")
+    return database
+
+def measure(func, bundles):
+    gc.collect()
+    tracemalloc.start()
+    database = func(bundles)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, len(database)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200000, help="number of assets to load")
+    parser.add_argument("--packages", type=int, default=100, help="number of packages to spread them over")
+    args = parser.parse_args()
+
+    print(f"Loading {args.count} assets, two copies each, from {args.packages} packages")
+    bundles = generate_bundles(args.count, args.packages)
+
+    results = {}
+    for name, func in (("asset dicts", load_dicts), ("asset records", load_records)):
+        results[name], num_assets = measure(func, bundles)
+        print(f"{name:>13}: {results[name] / (1024 * 1024):.1f} MiB ({results[name] / num_assets:.0f} bytes/asset)")
+    print(f"{'reduction':>13}: {1.0 - results['asset records'] / results['asset dicts']:.0%}")
@@ -0,0 +1,67 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the keys-only page scan against deserializing the entire page. Pass the pages of a
+real client (eg city_District_*.prp or Personal_District_*.prp) to see the effect on large pages.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+from PyHSPlasma import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+import package
+import synthetic_client
+
+def best_time(path, keys_only, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = package.find_page_externals(path, keys_only=keys_only)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def run(pages, repeat):
+    full_total, keys_total = 0.0, 0.0
+    for path in pages:
+        full, expected = best_time(path, False, repeat)
+        keys, result = best_time(path, True, repeat)
+        assert result == expected, f"keys-only scan of '{path.name}' does not match"
+        full_total += full
+        keys_total += keys
+        size_mb = path.stat().st_size / (1024 * 1024)
+        print(f"{path.name:>48} ({size_mb:7.1f} MiB): {full:.3f}s -> {keys:.3f}s ({full / keys:.1f}x)")
+    print(f"{'total':>61}: {full_total:.3f}s -> {keys_total:.3f}s ({full_total / keys_total:.1f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pages", type=Path, nargs="*", help="pages to scan (default: a synthetic client)")
+    parser.add_argument("--preset", choices=list(synthetic_client.presets.keys()), default="medium",
+                        help="size of the synthetic client to scan when no pages are given")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    plDebug.Init(plDebug.kDLNone)
+    if args.pages:
+        run(args.pages, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as td:
+            client_path = Path(td)
+            synthetic_client.generate_client(client_path, synthetic_client.presets[args.preset])
+            run(sorted(client_path.joinpath("dat").glob("*.prp")), args.repeat)
@@ -0,0 +1,112 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simulates a sharded build on several nodes with one process per shard, then checks that the
+merged shards are byte-identical to the merge of a single-node build of the same client.
+"""
+
+import argparse
+import filecmp
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+import synthetic_client
+
+_hurudist_path = Path(__file__).resolve().parent.parent.joinpath("hurudist")
+
+def _command(*args, python=None):
+    command = [sys.executable, str(_hurudist_path), "-q"] + [str(i) for i in args]
+    if python is None:
+        command.append("--no-pfm-py-dependencies")
+    else:
+        command.extend(("--python", str(python)))
+    return command
+
+def _merge(destination_path, *source_paths):
+    subprocess.run([sys.executable, str(_hurudist_path), "-q", "merge", *map(str, source_paths), str(destination_path),
+                    "--no-cache"], check=True)
+
+def build_single(client_path, work_path, jobs, python=None):
+    package_path = work_path.joinpath("single")
+    subprocess.run(_command("package", client_path, package_path, "--no-cache", "--jobs", jobs, python=python), check=True)
+    _merge(work_path.joinpath("single-merged"), package_path)
+    return work_path.joinpath("single-merged")
+
+def build_sharded(client_path, work_path, shard_count, jobs, python=None):
+    # Every node gets its own share of the machine, like it would get its own machine.
+    shard_jobs = max(1, jobs // shard_count)
+    shard_paths = [work_path.joinpath("shards", f"shard{i}") for i in range(1, shard_count + 1)]
+    nodes = [subprocess.Popen(_command("package", client_path, path, "--no-cache", "--jobs", shard_jobs,
+                                       "--shard", f"{i}/{shard_count}", python=python))
+             for i, path in enumerate(shard_paths, start=1)]
+    for i in nodes:
+        if i.wait() != 0:
+            raise subprocess.CalledProcessError(i.returncode, i.args)
+    _merge(work_path.joinpath("sharded-merged"), *shard_paths)
+    return work_path.joinpath("sharded-merged")
+
+def compare_trees(expected_path, actual_path):
+    """Returns the relative paths of every file that differs between the two directories."""
+    def _files(path):
+        return { i.relative_to(path) for i in path.rglob("*") if i.is_file() }
+
+    expected, actual = _files(expected_path), _files(actual_path)
+    different = expected ^ actual
+    for i in expected & actual:
+        if not filecmp.cmp(expected_path.joinpath(i), actual_path.joinpath(i), shallow=False):
+            different.add(i)
+    return sorted(different)
+
+def run(client_path, work_path, shard_counts, jobs, python=None):
+    start = time.perf_counter()
+    single_path = build_single(client_path, work_path, jobs, python)
+    print(f"{'single node':>12}: {time.perf_counter() - start:.3f}s")
+
+    ok = True
+    for shard_count in shard_counts:
+        shard_work_path = work_path.joinpath(f"{shard_count}-shards")
+        start = time.perf_counter()
+        sharded_path = build_sharded(client_path, shard_work_path, shard_count, jobs, python)
+        elapsed = time.perf_counter() - start
+
+        different = compare_trees(single_path, sharded_path)
+        ok &= not different
+        print(f"{shard_count:>5} shards: {elapsed:.3f}s, {'identical' if not different else 'DIFFERENT'}")
+        for i in different:
+            print(f"    {i}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--client", type=Path, help="client to package (default: a synthetic client)")
+    parser.add_argument("--preset", choices=list(synthetic_client.presets.keys()), default="medium",
+                        help="size of the synthetic client to package when no client is given")
+    parser.add_argument("--shards", nargs="+", type=int, default=[2, 4], help="shard counts to try")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes shared by all of the shards")
+    parser.add_argument("--python", type=Path, help="Uru-compatible python interpreter to resolve PythonFileMods with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as td:
+        client_path = args.client
+        if client_path is None:
+            client_path = Path(td, "client")
+            synthetic_client.generate_client(client_path, synthetic_client.presets[args.preset])
+        if not run(client_path, Path(td), args.shards, args.jobs, args.python):
+            sys.exit(1)
@@ -0,0 +1,141 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generates a synthetic Plasma client that is just real enough to be packaged."""
+
+import argparse
+import dataclasses
+import os
+from pathlib import Path
+import random
+import sys
+
+from PyHSPlasma import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+from _constants import client_sdl, client_subdirectories
+
+@dataclasses.dataclass
+class ClientSpec:
+    ages: int = 4
+    pages_per_age: int = 4
+    pfms_per_page: int = 8
+    sounds_per_page: int = 8
+    python_modules: int = 64
+    max_sfx_size: int = 1024 * 1024
+    videos: int = 4
+    max_avi_size: int = 8 * 1024 * 1024
+    seed: int = 0
+
+
+# Presets for the benchmark suite, roughly a single age, a small shard, and a MOULa sized client.
+presets = {
+    "small": ClientSpec(ages=2, pages_per_age=2, pfms_per_page=4, sounds_per_page=4, python_modules=16,
+                        max_sfx_size=256 * 1024, videos=2, max_avi_size=1024 * 1024),
+    "medium": ClientSpec(),
+    "large": ClientSpec(ages=32, pages_per_age=8, pfms_per_page=16, sounds_per_page=16, python_modules=512,
+                        videos=8, max_avi_size=32 * 1024 * 1024),
+}
+
+def _write_blob(path, rng, max_size):
+    # Random bytes don't compress, like the real media, and don't dedup by accident.
+    path.write_bytes(os.urandom(rng.randint(max_size // 4, max_size)))
+
+def _write_page(path, age_name, page_name, seq_prefix, page_suffix, pfm_modules, sound_files, rng):
+    mgr = plResManager(pvMoul)
+    location = plLocation(pvMoul)
+    location.prefix = seq_prefix
+    location.page = page_suffix
+    page = plPageInfo()
+    page.location = location
+    page.age = age_name
+    page.page = page_name
+    mgr.AddPage(page)
+
+    for i, module_name in enumerate(pfm_modules):
+        pfm = plPythonFileMod(f"{page_name}_PFM{i}")
+        pfm.filename = module_name
+        mgr.AddObject(location, pfm)
+    for i, sound_file in enumerate(sound_files):
+        sound = plSoundBuffer(f"{page_name}_Sound{i}")
+        sound.fileName = sound_file
+        sound.flags = rng.choice((0, plSoundBuffer.kStreamCompressed, plSoundBuffer.kOnlyLeftChannel))
+        mgr.AddObject(location, sound)
+    mgr.WritePage(path, page)
+
+def _write_sdl(path, descriptors):
+    with path.open("w") as stream:
+        for i in descriptors:
+            stream.write(f"STATEDESC {i}\n{{\n    VERSION 1\n    VAR INT value[1] DEFAULT=0\n}}\n\n")
+
+def generate_client(client_path, spec):
+    """Writes a client described by the `ClientSpec` to `client_path`. The same spec always
+       produces the same client layout, though the media blobs are random.
+    """
+    rng = random.Random(spec.seed)
+    paths = { key: client_path.joinpath(value) for key, value in client_subdirectories.items() }
+    for i in paths.values():
+        i.mkdir(parents=True, exist_ok=True)
+    client_path.joinpath("extras").mkdir(exist_ok=True)
+
+    # Client artifacts
+    for i in ("UruExplorer.exe", "UruLauncher.exe", "plClient.exe", "d3dx9_43.dll", "OpenAL32.dll"):
+        _write_blob(paths["artifacts"].joinpath(i), rng, 256 * 1024)
+    _write_blob(client_path.joinpath("extras", "vcredist_x86.exe"), rng, 1024 * 1024)
+
+    # Python: the engine code, and modules for the PythonFileMods with a state descriptor each.
+    for i in ("plasma", "system"):
+        paths["python"].joinpath(i).mkdir(exist_ok=True)
+        for j in range(4):
+            paths["python"].joinpath(i, f"{i}{j}.py").write_text(f"# {i} module {j}\n")
+    modules = [f"xSynthetic{i:04}" for i in range(spec.python_modules)]
+    for i in modules:
+        paths["python"].joinpath(f"{i}.py").write_text(f"from Plasma import *\n\nclass {i}(ptModifier):\n    pass\n")
+    _write_sdl(paths["sdl"].joinpath("client.sdl"), sorted(client_sdl))
+    _write_sdl(paths["sdl"].joinpath("synthetic.sdl"), modules)
+
+    # Videos, including the ones that are a part of the client.
+    for i in range(spec.videos):
+        _write_blob(paths["avi"].joinpath(f"intro{i}.webm" if i < 2 else f"Synthetic{i}.webm"), rng, spec.max_avi_size)
+
+    # Ages and their pages
+    for age_index in range(spec.ages):
+        age_name = f"Synthetic{age_index:03}"
+        seq_prefix = 100 + age_index
+        age_info = plAgeInfo()
+        age_info.name = age_name
+        age_info.seqPrefix = seq_prefix
+        for page_index in range(spec.pages_per_age):
+            page_name = f"Page{page_index:02}"
+            age_info.addPage((page_name, page_index, 0))
+
+            sound_files = [f"{age_name}_{page_name}_{i:03}.ogg" for i in range(spec.sounds_per_page)]
+            for i in sound_files:
+                _write_blob(paths["sfx"].joinpath(i), rng, spec.max_sfx_size)
+            pfm_modules = rng.sample(modules, min(spec.pfms_per_page, len(modules)))
+            page_path = paths["data"].joinpath(f"{age_name}_District_{page_name}.prp")
+            _write_page(page_path, age_name, page_name, seq_prefix, page_index, pfm_modules, sound_files, rng)
+        age_info.writeToFile(paths["data"].joinpath(f"{age_name}.age"), pvMoul)
+        paths["data"].joinpath(f"{age_name}.fni").write_text("Graphics.Renderer.SetYon 100000\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("destination", type=Path, help="path to write the client to")
+    parser.add_argument("--preset", choices=list(presets.keys()), default="medium")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    spec = dataclasses.replace(presets[args.preset], seed=args.seed)
+    generate_client(args.destination, spec)
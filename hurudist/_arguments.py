@@ -24,6 +24,34 @@ log_group = main_parser.add_mutually_exclusive_group()
 log_group.add_argument("-q", "--quiet", action="store_true", help="only print critical information")
 log_group.add_argument("-v", "--verbose", action="store_true", help="print verbose log output")
 
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", type=Path, help="directory to store the persistent cache in (default: next to the destination)")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument("--no-cache", action="store_true", help="don't use the persistent cache")
+    cache_group.add_argument("--rebuild-cache", action="store_true", help="discard the persistent cache before starting")
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", type=Path, metavar="REPORT", help="write the timings of each stage of the run to this JSON file")
+    parser.add_argument("--cprofile", type=Path, metavar="DIR", help="with --profile, also dump cProfile stats of the main thread for each stage to this directory")
+
+def _shard(value):
+    try:
+        index, count = (int(i) for i in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected INDEX/COUNT")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', INDEX must be between 1 and COUNT")
+    return index, count
+
+class _ExtraClientAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        arch, path = values
+        if arch not in ClientArch.__members__:
+            parser.error(f"argument {option_string}: invalid client architecture '{arch}'")
+        clients = list(getattr(namespace, self.dest) or [])
+        clients.append((ClientArch[arch], Path(path)))
+        setattr(namespace, self.dest, clients)
+
 sub_parsers = main_parser.add_subparsers(title="Command", dest="command", required=True)
 
 # Package age command argment parser
@@ -34,10 +62,14 @@ package_parser.add_argument("destination", type=Path, help="path to store the re
 client_group = package_parser.add_argument_group()
 client_group.add_argument("--no-client", action="store_true", help="don't package the client")
 client_group.add_argument("--client-arch", type=lambda x: ClientArch[x], default=ClientArch.i386)
+client_group.add_argument("--extra-client", nargs=2, action=_ExtraClientAction, default=[], metavar=("ARCH", "PATH"),
+                          help="also package the client of another architecture, sharing everything but its artifacts")
 
 age_group = package_parser.add_mutually_exclusive_group()
 age_group.add_argument("--age", type=str, help="package only this age")
 age_group.add_argument("--no-ages", action="store_true", help="don't package any age files")
+age_group.add_argument("--shard", type=_shard, metavar="INDEX/COUNT",
+                       help="package only this share of the ages, split by page size, and the client with the first share")
 
 package_parser.add_argument("--dataset", type=lambda x: Dataset[x], default=Dataset.base, choices=list(Dataset),
                         help="dataset this age belongs to")
@@ -51,8 +83,62 @@ pfmdeps_group.add_argument("--no-pfm-dependencies", action="store_true", help="d
 pfmdeps_group.add_argument("--no-pfm-py-dependencies", action="store_true", help="don't include modules imported by PythonFileModifier modules")
 pfmdeps_group.add_argument("--no-pfm-sdl-dependencies", action="store_true", help="don't include PythonSDLModifiers")
 
+package_parser.add_argument("--jobs", "-j", type=int, help="number of processes used to parse pages and hash assets (default: number of CPUs)")
+package_parser.add_argument("--io-jobs", type=int, default=8, help="number of threads used for filesystem work and Python dependency resolution")
+package_parser.add_argument("--compress", type=lambda x: Compression[x], default=Compression.none, choices=list(Compression),
+                        help="create compressed copies of the assets for file servers")
+package_parser.add_argument("--compress-min-savings", type=int, default=10, metavar="PERCENT",
+                        help="only keep compressed copies that are at least this much smaller (default: 10)")
+package_parser.add_argument("--incremental", action="store_true", help="update an existing package at the destination in place")
+package_parser.add_argument("--dedup", action="store_true", help="link assets with identical contents together instead of copying them again")
+package_parser.add_argument("--watch", action="store_true", help="keep running and update the destination whenever the client changes")
+package_parser.add_argument("--watch-interval", type=float, default=2.0, metavar="SECONDS",
+                            help="how long to wait for the client to settle after a change when watching. Without the watchdog "
+                                 "module, this is also how often the whole client is listed again to find changes, which "
+                                 "reads every directory of the client each time (default: 2)")
+add_cache_arguments(package_parser)
+add_profile_arguments(package_parser)
+
 
 # Merge command argument parser
 merge_parser = sub_parsers.add_parser("merge")
-merge_parser.add_argument("source", type=Path, help="path to the root of the asset database to merge")
+merge_parser.add_argument("sources", type=Path, nargs="+", metavar="source",
+                          help="path to the root of an asset database to merge, such as each shard of a package")
 merge_parser.add_argument("destination", type=Path, help="path to store the resulting asset package")
+merge_parser.add_argument("--jobs", "-j", type=int, help="number of processes used to load the asset database (default: number of CPUs)")
+merge_parser.add_argument("--link-mode", type=lambda x: LinkMode[x], default=LinkMode.copy, choices=list(LinkMode),
+                          help="link the merged assets to the source database instead of copying them, if possible")
+merge_parser.add_argument("--verify", nargs="?", const="full", choices=("full", "quick"),
+                          help="check the source files against their recorded digests (full) or size and modify time (quick)")
+add_cache_arguments(merge_parser)
+add_profile_arguments(merge_parser)
+
+
+# Manifest command argument parser
+manifest_parser = sub_parsers.add_parser("manifest")
+manifest_parser.add_argument("source", type=Path, help="path to the root of the asset database to generate manifests for")
+manifest_parser.add_argument("destination", type=Path, help="path to store the resulting FileSrv manifests and downloads")
+manifest_parser.add_argument("--client-arch", type=lambda x: ClientArch[x], default=ClientArch.i386, choices=list(ClientArch))
+manifest_parser.add_argument("--client-os", type=lambda x: ClientOS[x], default=ClientOS.win, choices=list(ClientOS))
+manifest_parser.add_argument("--jobs", "-j", type=int, help="number of processes used to load the asset database and compress downloads (default: number of CPUs)")
+manifest_parser.add_argument("--link-mode", type=lambda x: LinkMode[x], default=LinkMode.copy, choices=list(LinkMode),
+                             help="link downloads to the source database instead of copying them, if possible")
+
+
+# Diff command argument parser
+diff_parser = sub_parsers.add_parser("diff")
+diff_parser.add_argument("old", type=Path, help="path to the root of the previous asset database")
+diff_parser.add_argument("new", type=Path, help="path to the root of the updated asset database")
+diff_parser.add_argument("destination", type=Path, help="path to store the resulting patch package")
+diff_parser.add_argument("--jobs", "-j", type=int, help="number of processes used to load the asset databases (default: number of CPUs)")
+diff_parser.add_argument("--link-mode", type=lambda x: LinkMode[x], default=LinkMode.copy, choices=list(LinkMode),
+                         help="link the patch assets to the updated database instead of copying them, if possible")
+
+
+# Apply command argument parser
+apply_parser = sub_parsers.add_parser("apply")
+apply_parser.add_argument("database", type=Path, help="path to the root of the asset database to update in place")
+apply_parser.add_argument("patch", type=Path, help="path to the patch package made by the diff command")
+apply_parser.add_argument("--jobs", "-j", type=int, help="number of processes used to load the asset databases (default: number of CPUs)")
+apply_parser.add_argument("--link-mode", type=lambda x: LinkMode[x], default=LinkMode.copy, choices=list(LinkMode),
+                          help="link the updated assets to the patch package instead of copying them, if possible")
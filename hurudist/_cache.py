@@ -0,0 +1,168 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import functools
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+
+CACHE_FILENAME = "hurudist-cache.sqlite"
+
+# Bump this whenever the layout of any of the cache tables changes.
+_SCHEMA_VERSION = 2
+
+def _locked(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+def open_cache(args):
+    """Opens the persistent cache requested on the command line, if any."""
+    if args.no_cache:
+        return contextlib.nullcontext()
+    cache_dir = args.cache_dir if args.cache_dir else args.destination.parent
+    return AssetCache(cache_dir.joinpath(CACHE_FILENAME), rebuild=args.rebuild_cache)
+
+
+class AssetCache:
+    """Persistent cache of per-file results that survives between runs. Entries are keyed by the
+       resolved path of the file and are only valid as long as its size, mtime, and inode match.
+    """
+
+    def __init__(self, path, rebuild=False):
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        logging.debug(f"Opening cache '{path}'...")
+        # The cache is shared by the callbacks of the pipeline's pools.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._directories = {}
+        self._listed_roots = []
+        self._listed_files = set()
+        self.hash_hits = 0
+        self.hash_misses = 0
+
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if rebuild or version != _SCHEMA_VERSION:
+            if version and version != _SCHEMA_VERSION:
+                logging.info(f"Cache schema is out of date (v{version}), rebuilding...")
+            for table in ("hashes", "page_scans"):
+                self._db.execute(f"DROP TABLE IF EXISTS {table}")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                mtime_ns INTEGER NOT NULL,
+                                inode INTEGER NOT NULL,
+                                hash_md5 TEXT NOT NULL,
+                                hash_sha2 TEXT NOT NULL
+                            )""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS page_scans (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                mtime_ns INTEGER NOT NULL,
+                                inode INTEGER NOT NULL,
+                                hash_sha2 TEXT NOT NULL,
+                                version INTEGER NOT NULL,
+                                result TEXT NOT NULL
+                            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS page_scans_hash ON page_scans (hash_sha2, version)")
+        self._db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    @_locked
+    def __exit__(self, type, value, traceback):
+        # Everything computed before a failure is still good for the next run.
+        if type is None:
+            self.evict_missing()
+        self._db.commit()
+        self._db.close()
+        return False
+
+    def _resolve(self, path):
+        # Resolving a path looks up each of its components, so each directory is only resolved once.
+        directory = self._directories.get(path.parent)
+        if directory is None:
+            directory = self._directories[path.parent] = path.parent.resolve()
+        return directory.joinpath(path.name)
+
+    def _key(self, path, stat):
+        return (str(self._resolve(path)), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    @_locked
+    def set_listing(self, directories, paths):
+        """Records the (path, recursive) `directories` that were listed this run and the `paths`
+           of every file found in them, so that `evict_missing()` need not look up each entry.
+        """
+        self._listed_roots = [(self._resolve(path), recursive) for path, recursive in directories]
+        self._listed_files = { str(self._resolve(i)) for i in paths }
+
+    def _is_listed(self, path):
+        parent = pathlib.Path(path).parent
+        return any(parent == root or (recursive and root in parent.parents) for root, recursive in self._listed_roots)
+
+    @_locked
+    def evict_missing(self):
+        """Discards entries for files that were missing from this run's directory listings.
+           Entries outside of the listed directories are left alone.
+        """
+        for table in ("hashes", "page_scans"):
+            missing = [(path,) for path, in self._db.execute(f"SELECT path FROM {table}")
+                       if path not in self._listed_files and self._is_listed(path)]
+            if missing:
+                logging.debug(f"Evicting {len(missing)} stale entries from the {table} cache.")
+                self._db.executemany(f"DELETE FROM {table} WHERE path = ?", missing)
+
+    @_locked
+    def lookup_hashes(self, path, stat):
+        """Returns the cached digests for the file at `path` or None if the file has changed."""
+        row = self._db.execute("SELECT hash_md5, hash_sha2 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                               self._key(path, stat)).fetchone()
+        if row is None:
+            self.hash_misses += 1
+            return None
+        self.hash_hits += 1
+        return { "hash_md5": row[0], "hash_sha2": row[1] }
+
+    @_locked
+    def store_hashes(self, path, stat, hashes):
+        self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                         self._key(path, stat) + (hashes["hash_md5"], hashes["hash_sha2"]))
+
+    @_locked
+    def lookup_page(self, path, stat, version):
+        """Returns the cached scan results of the page at `path` or None if the page has changed."""
+        row = self._db.execute("SELECT result FROM page_scans WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ? AND version = ?",
+                               self._key(path, stat) + (version,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    @_locked
+    def lookup_page_hash(self, hash_sha2, version):
+        """Returns the cached scan results of any page whose contents match the given hash."""
+        row = self._db.execute("SELECT result FROM page_scans WHERE hash_sha2 = ? AND version = ?",
+                               (hash_sha2, version)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    @_locked
+    def store_page(self, path, stat, hash_sha2, version, result):
+        self._db.execute("INSERT OR REPLACE INTO page_scans VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         self._key(path, stat) + (hash_sha2, version, json.dumps(result)))
@@ -84,6 +84,30 @@ class ClientOS(_ArgParseEnum, enum.Enum):
     win = enum.auto()
 
 
+@enum.unique
+class Compression(_ArgParseEnum, enum.Enum):
+    gzip = enum.auto()
+    none = enum.auto()
+
+
+@enum.unique
+class LinkMode(_ArgParseEnum, enum.Enum):
+    copy = enum.auto()
+    hardlink = enum.auto()
+    reflink = enum.auto()
+    auto = enum.auto()
+
+
+@enum.unique
+class ManifestFlags(enum.IntFlag):
+    # From the MOUL FileSrv protocol
+    sound_cache_split = 1 << 0
+    sound_stream_compressed = 1 << 1
+    sound_cache_stereo = 1 << 2
+    zipped = 1 << 3
+    redist_update = 1 << 4
+
+
 @enum.unique
 class Dataset(_ArgParseEnum, enum.IntEnum):
     cyan = enum.auto()
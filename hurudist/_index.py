@@ -0,0 +1,149 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import pathlib
+import sqlite3
+import tempfile
+
+INDEX_FILENAME = "contents.sqlite"
+
+# Bump this whenever the layout of the index changes.
+_SCHEMA_VERSION = 1
+
+_hash_keys = ("hash_md5", "hash_sha2", "compressed_hash_md5", "compressed_hash_sha2")
+_columns = ("source", "compressed_source", "size", "compressed_size", "modify_time") + _hash_keys + \
+           ("dataset", "distribute", "options")
+
+def write_index(outfile, packages):
+    """Writes a binary index of the given packages next to their contents files. `packages` is a
+       sequence of (subpackage name, path of the package YAML, package dict) in the order the
+       packages are listed by the bundle. Sources are stored relative to the bundle root.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = pathlib.Path(temp_dir, INDEX_FILENAME)
+        db = sqlite3.connect(temp_path)
+        try:
+            db.execute("CREATE TABLE packages (name TEXT, source TEXT NOT NULL)")
+            db.execute(f"""CREATE TABLE assets (
+                               category TEXT NOT NULL,
+                               filename TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               subpackage TEXT,
+                               source TEXT NOT NULL,
+                               compressed_source TEXT,
+                               size INTEGER,
+                               compressed_size INTEGER,
+                               modify_time INTEGER,
+                               {", ".join(f"{i} BLOB" for i in _hash_keys)},
+                               dataset TEXT,
+                               distribute TEXT,
+                               options TEXT,
+                               extra TEXT
+                           )""")
+
+            for subpackage_name, yaml_path, package_dict in packages:
+                db.execute("INSERT INTO packages VALUES (?, ?)", (subpackage_name, str(yaml_path)))
+                relative_path = pathlib.PureWindowsPath(yaml_path).parent
+                db.executemany(f"INSERT INTO assets VALUES ({', '.join('?' * (5 + len(_columns)))})",
+                               (_make_row(asset_category, asset_filename, subpackage_name, relative_path, asset_dict)
+                                for asset_category, assets in package_dict.items()
+                                for asset_filename, asset_dict in assets.items()))
+
+            # Built after the rows are in, which is much faster than maintaining it.
+            db.execute("CREATE INDEX assets_key ON assets (category, key)")
+            db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            db.commit()
+        finally:
+            db.close()
+        outfile.copy_file(temp_path, pathlib.Path(INDEX_FILENAME))
+
+def _make_row(asset_category, asset_filename, subpackage_name, relative_path, asset_dict):
+    asset_dict = dict(asset_dict)
+    row = [asset_category.lower(), asset_filename, asset_filename.lower(), subpackage_name]
+    for key in ("source", "compressed_source"):
+        value = asset_dict.pop(key, None)
+        row.append(str(relative_path.joinpath(value)) if value is not None else None)
+    for key in ("size", "compressed_size", "modify_time"):
+        row.append(asset_dict.pop(key, None))
+    for key in _hash_keys:
+        value = asset_dict.pop(key, None)
+        row.append(bytes.fromhex(value) if value is not None else None)
+    for key in ("dataset", "distribute"):
+        value = asset_dict.get(key)
+        row.append(asset_dict.pop(key) if isinstance(value, str) else None)
+    options = asset_dict.pop("options", None)
+    row.append(json.dumps(list(options)) if options is not None else None)
+    row.append(json.dumps(asset_dict) if asset_dict else None)
+    return row
+
+
+class AssetIndex:
+    """A binary index written by `write_index()`. Assets are looked up in O(log n) without
+       reading the rest of the bundle.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        self.valid = version == _SCHEMA_VERSION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._db.close()
+        return False
+
+    def __iter__(self):
+        """Yields (asset_category, asset_filename, subpackage_name, asset_dict) for every asset in
+           the order they are listed by the bundle.
+        """
+        for row in self._db.execute("SELECT * FROM assets ORDER BY rowid"):
+            yield self._make_asset(row)
+
+    def is_current(self, bundle_path):
+        """Determines if the index is at least as new as the YAML files of the bundle it indexes."""
+        if not self.valid:
+            return False
+        mtime = self._path.stat().st_mtime_ns
+        for source, in self._db.execute("SELECT source FROM packages"):
+            try:
+                if bundle_path.joinpath(*pathlib.PureWindowsPath(source).parts).stat().st_mtime_ns > mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def lookup(self, asset_category, asset_filename):
+        """Returns (subpackage_name, asset_dict) for every copy of the given asset."""
+        rows = self._db.execute("SELECT * FROM assets WHERE category = ? AND key = ? ORDER BY rowid",
+                                (asset_category.lower(), asset_filename.lower()))
+        return [self._make_asset(row)[2:] for row in rows]
+
+    @staticmethod
+    def _make_asset(row):
+        asset_category, asset_filename, _, subpackage_name = row[:4]
+        asset_dict = json.loads(row[-1]) if row[-1] is not None else {}
+        for key, value in zip(_columns, row[4:-1]):
+            if value is None:
+                continue
+            if key in _hash_keys:
+                value = value.hex()
+            elif key == "options":
+                value = json.loads(value)
+            asset_dict[key] = value
+        return asset_category, asset_filename, subpackage_name, asset_dict
@@ -0,0 +1,255 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import functools
+import logging
+import multiprocessing, multiprocessing.pool
+import os
+import threading
+import _utils
+
+def _list_directory(path, recursive=True):
+    """Returns the `os.stat_result` of every file in the directory given by `path`, gathered from
+       a directory listing rather than one lookup per file.
+    """
+    stats = {}
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if recursive:
+                                pending.append(directory.joinpath(entry.name))
+                        else:
+                            stats[directory.joinpath(entry.name)] = entry.stat()
+                    except FileNotFoundError:
+                        pass
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    return stats
+
+
+class Pipeline:
+    """Shared executors for a single run. Work is handed to the next stage as soon as its inputs
+       are known so that page parsing, dependency resolution, hashing, and copying all overlap.
+
+       CPU-bound work runs in `pool` (a process pool) while filesystem work runs in `io_pool`.
+       Each piece of work belongs to a named group, and `wait()` blocks until a group drains,
+       including any follow-up work submitted by callbacks while waiting.
+
+       Callbacks are run on the pools' result threads, so they must never block.
+    """
+
+    def __init__(self, jobs=None, io_jobs=None, cache=None, profiler=None):
+        self.pool = multiprocessing.pool.Pool(jobs, initializer=_utils.multiprocess_init)
+        self.io_pool = multiprocessing.pool.ThreadPool(io_jobs)
+        self.cache = cache
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.set_pool_sizes(jobs or os.cpu_count(), io_jobs or os.cpu_count())
+
+        self._cond = threading.Condition()
+        self._outstanding = collections.Counter()
+        self._stats = {}
+        self._listed = {}
+        self._directories = []
+        self._hashes = {}
+        self._stat_waiters = {}
+        self._hash_waiters = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for pool in (self.pool, self.io_pool):
+            if type is None:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        return False
+
+    def acquire(self, group):
+        """Marks a piece of work in `group` as outstanding."""
+        with self._cond:
+            self._outstanding[group] += 1
+
+    def release(self, group):
+        """Marks a piece of work in `group` as complete."""
+        with self._cond:
+            self._outstanding[group] -= 1
+            if not self._outstanding[group]:
+                self._cond.notify_all()
+
+    def submit(self, pool, group, func, args=(), callback=None, error_callback=None):
+        """Runs `func(*args)` in `pool`, then passes the result to `callback`."""
+        def _callback(result):
+            try:
+                if callback is not None:
+                    callback(result)
+            except Exception as ex:
+                logging.exception(ex)
+            finally:
+                self.release(group)
+
+        def _error_callback(ex):
+            try:
+                if error_callback is not None:
+                    error_callback(ex)
+                else:
+                    logging.exception(ex)
+            finally:
+                self.release(group)
+
+        if self.profiler is not None:
+            func, args, callback = self.profiler.instrument(pool is self.pool, group, func, args, callback)
+        self.acquire(group)
+        pool.apply_async(func, args, callback=_callback, error_callback=_error_callback)
+
+    def wait(self, *groups):
+        """Blocks until all work in the given groups has finished."""
+        with self._cond:
+            self._cond.wait_for(lambda: not any(self._outstanding[i] for i in groups))
+
+    def add_asset(self, path):
+        """Starts collecting the stat and digests of the file given by `path`. Each file is only
+           examined once, no matter how many times it is added.
+        """
+        with self._cond:
+            if path in self._stat_waiters or path in self._stats:
+                return
+            self._stat_waiters[path] = []
+            stat = self._listed.get(path)
+        if stat is not None:
+            self._on_stat(path, stat)
+        else:
+            self.submit(self.io_pool, "stat", _utils.stat_file, (path,), functools.partial(self._on_stat, path))
+
+    def list_directories(self, directories):
+        """Lists each of the (path, recursive) `directories` at once in the I/O pool, so that the
+           files in them need not be looked up one at a time. Files missing from the listings are
+           still looked up individually, which catches names that only match ignoring case.
+        """
+        for stats in self.io_pool.starmap(_list_directory, directories, chunksize=1):
+            with self._cond:
+                self._listed.update(stats)
+        with self._cond:
+            self._directories.extend(directories)
+            if self.cache is not None:
+                self.cache.set_listing(self._directories, self._listed.keys())
+
+    def update_directories(self, directories):
+        """Lists the (path, recursive) `directories` again, forgetting the stat and digests of
+           every file that was added, removed, or modified since the last listing. Returns the
+           paths of those files. Files that were only looked up individually are not checked.
+        """
+        listed = {}
+        for stats in self.io_pool.starmap(_list_directory, directories, chunksize=1):
+            listed.update(stats)
+
+        def _key(stat):
+            return (stat.st_size, stat.st_mtime_ns) if stat is not None else None
+
+        with self._cond:
+            changed = { path for path in listed.keys() | self._listed.keys()
+                        if _key(listed.get(path)) != _key(self._listed.get(path)) }
+            self._listed = listed
+            self._directories = list(directories)
+            if self.cache is not None:
+                self.cache.set_listing(self._directories, self._listed.keys())
+            for path in changed:
+                self._stats.pop(path, None)
+                self._hashes.pop(path, None)
+        return changed
+
+    def list_files(self, directory):
+        """Returns the sorted paths of the files in `directory`, not including its subdirectories.
+           They are taken from the listings if the directory was listed.
+        """
+        with self._cond:
+            if any(directory == path or (recursive and path in directory.parents) for path, recursive in self._directories):
+                return sorted(i for i in self._listed.keys() if i.parent == directory)
+        return _utils.list_files(directory)
+
+    def stat(self, path):
+        """Returns the `os.stat_result` of the file given by `path`, or None if it does not exist."""
+        with self._cond:
+            stat = self._stats.get(path) or self._listed.get(path)
+        return stat if stat is not None else _utils.stat_file(path)
+
+    def _on_stat(self, path, stat):
+        hashes = None
+        if stat is not None:
+            hashes = self.cache.lookup_hashes(path, stat) if self.cache is not None else None
+            if hashes is None:
+                # Submitted before the stat is released so that waiting on both groups can never
+                # observe them draining in between.
+                self.submit(self.pool, "hash", _utils.hash_file, (path,),
+                            functools.partial(self._on_hash_complete, path, stat),
+                            functools.partial(self._on_hash_failed, path))
+
+        with self._cond:
+            self._stats[path] = stat
+            waiters = self._stat_waiters.pop(path)
+        for i in waiters:
+            i(stat)
+        if stat is None or hashes is not None:
+            self._on_hashed(path, hashes)
+
+    def _on_hash_complete(self, path, stat, hashes):
+        if self.cache is not None:
+            self.cache.store_hashes(path, stat, hashes)
+        self._on_hashed(path, hashes)
+
+    def _on_hashed(self, path, hashes):
+        with self._cond:
+            self._hashes[path] = hashes
+            waiters = self._hash_waiters.pop(path, [])
+        for i in waiters:
+            i(hashes)
+
+    def _on_hash_failed(self, path, ex):
+        logging.exception(ex)
+        self._on_hashed(path, None)
+
+    def on_stat(self, path, callback):
+        """Calls `callback` with the `os.stat_result` of an added asset (or None if the file does
+           not exist) as soon as it is known.
+        """
+        with self._cond:
+            if path not in self._stats:
+                self._stat_waiters[path].append(callback)
+                return
+            stat = self._stats[path]
+        callback(stat)
+
+    def on_hashed(self, path, callback):
+        """Calls `callback` with the digests of an added asset (or None if the asset could not be
+           hashed) as soon as they are known.
+        """
+        with self._cond:
+            if path not in self._hashes:
+                self._hash_waiters.setdefault(path, []).append(callback)
+                return
+            hashes = self._hashes[path]
+        callback(hashes)
+
+    def get_stat(self, path):
+        """Returns the `os.stat_result` of an added asset once the "stat" group has finished."""
+        return self._stats[path]
@@ -0,0 +1,181 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so there is no peak RSS to report there.
+    resource = None
+
+# Work in these pipeline groups is reported one call at a time, labeled by its first argument.
+_detailed_groups = frozenset(("scan", "pfm"))
+# Work in these pipeline groups reads the file given by its first argument from start to finish.
+_sized_groups = frozenset(("hash", "compress", "copy"))
+
+def open_profiler(args):
+    """Opens the profiler requested on the command line, if any."""
+    if not args.profile:
+        return contextlib.nullcontext()
+    return Profiler(args.profile, args.cprofile)
+
+def stage(profiler, name):
+    """Times the phase `name` of a run if a profiler is open."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+def timed_call(func, args, sized):
+    """Runs `func(*args)` in a pool worker and returns its result along with the wall and CPU
+       time it took and, if `sized`, the size of the file it worked on.
+    """
+    wall, cpu = time.perf_counter(), time.thread_time()
+    result = func(*args)
+    wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+    size = os.stat(args[0]).st_size if sized else None
+    return result, wall, cpu, size
+
+def _max_rss(children=False):
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but macOS reports bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    """Collects the timings of a single run and writes them to a JSON report on exit. Each phase
+       of the run is timed with `stage()`. Work submitted to a `Pipeline` is timed individually,
+       and the time spent in the pools counts against the stage that is running when it ends.
+    """
+
+    def __init__(self, path, cprofile_path=None):
+        self._path = path
+        self._cprofile_path = cprofile_path
+        self._lock = threading.Lock()
+        self._start = (time.perf_counter(), time.process_time())
+        self._stages = []
+        self._current = None
+        self._tasks = {}
+        self._details = {}
+        self._pool_sizes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.write_report()
+        return False
+
+    def set_pool_sizes(self, processes, threads):
+        self._pool_sizes = { "process": processes, "thread": threads }
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = { "name": name, "wall": 0.0, "cpu": 0.0, "worker_cpu": 0.0, "busy": { "process": 0.0, "thread": 0.0 } }
+        with self._lock:
+            self._stages.append(record)
+            self._current = record
+
+        profile = cProfile.Profile() if self._cprofile_path is not None else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            with self._lock:
+                self._current = None
+            if profile is not None:
+                self._cprofile_path.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(self._cprofile_path.joinpath(f"{len(self._stages):02}-{name}.prof"))
+
+    def instrument(self, process, group, func, args, callback):
+        """Wraps work about to be submitted to a pool, returning the function, arguments, and
+           callback to submit instead.
+        """
+        def _callback(result):
+            result, wall, cpu, size = result
+            self._record(process, group, args[0], wall, cpu, size)
+            if callback is not None:
+                callback(result)
+        return timed_call, (func, args, group in _sized_groups), _callback
+
+    def _record(self, process, group, label, wall, cpu, size):
+        with self._lock:
+            task = self._tasks.setdefault(group, { "count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0 })
+            task["count"] += 1
+            task["wall"] += wall
+            task["cpu"] += cpu
+            if size is not None:
+                task["bytes"] += size
+            if group in _detailed_groups:
+                self._details.setdefault(group, []).append({ "name": str(label), "wall": wall, "cpu": cpu })
+            if self._current is not None:
+                self._current["busy"]["process" if process else "thread"] += wall
+                if process:
+                    self._current["worker_cpu"] += cpu
+
+    def write_report(self):
+        total_wall = time.perf_counter() - self._start[0]
+        stages = []
+        for record in self._stages:
+            stage = dict(record)
+            busy = stage.pop("busy")
+            for pool, size in self._pool_sizes.items():
+                if stage["wall"] and size:
+                    stage[f"{pool}_pool_utilization"] = busy[pool] / (stage["wall"] * size)
+            stages.append(stage)
+
+        tasks = {}
+        for group, task in sorted(self._tasks.items()):
+            task = dict(task)
+            if task["bytes"]:
+                # Per worker, and for the run as a whole
+                task["mb_per_s"] = task["bytes"] / (1024 * 1024) / task["wall"] if task["wall"] else None
+                task["mb_per_s_overall"] = task["bytes"] / (1024 * 1024) / total_wall
+            tasks[group] = task
+
+        report = {
+            "command": sys.argv[1:],
+            "wall": total_wall,
+            "cpu": time.process_time() - self._start[1],
+            "pool_sizes": self._pool_sizes,
+            "stages": stages,
+            "tasks": tasks,
+            # The slowest of everything first, because those are the interesting ones.
+            "pages": sorted(self._details.get("scan", []), key=lambda x: x["wall"], reverse=True),
+            "python_modules": sorted(self._details.get("pfm", []), key=lambda x: x["wall"], reverse=True),
+            "peak_rss": {
+                "parent": _max_rss(),
+                # Only includes the workers that have already exited.
+                "workers": _max_rss(children=True),
+            },
+        }
+        logging.info(f"Writing profile report '{self._path}'...")
+        with open(self._path, "w") as stream:
+            json.dump(report, stream, indent=4)
@@ -18,18 +18,15 @@ import inspect
 import os.path
 import sys
 
-def get_imports(py_module_name, *module_paths):
-    """Gets a list of non-system imports"""
-
-    # This could be done in an environment variable, but that seems kind of nasty.
-    sys.path.extend(module_paths)
-
+def _import_module(py_module_name):
+    """Imports the requested module, returning one of the TOOLS_* result codes"""
     if sys.version_info[0] == 2:
         import imp
 
-        py_module_tup = imp.find_module(py_module_name)
-        if not py_module_tup:
-            sys.exit(TOOLS_FILE_NOT_FOUND)
+        try:
+            py_module_tup = imp.find_module(py_module_name)
+        except ImportError:
+            return TOOLS_FILE_NOT_FOUND
 
         try:
             # This is nested because try... except... finally was not possible until Python 2.5
@@ -37,17 +34,27 @@ def get_imports(py_module_name, *module_paths):
                 the_py_module = imp.load_module(py_module_name, *py_module_tup)
             except:
                 sys.excepthook(*sys.exc_info())
-                sys.exit(TOOLS_MODULE_TRACEBACK)
+                return TOOLS_MODULE_TRACEBACK
         finally:
-            py_module_tup[0].close()
+            if py_module_tup[0]:
+                py_module_tup[0].close()
     else:
         # This will work in Python 2.7 as well, but I want the above code to be well-tested in the
         # case of Python 2.3. The only reason I have this is because Python 3.x "helpfully" prints
         # a deprecation message.
         import importlib
-        the_py_module = importlib.import_module(py_module_name)
+        try:
+            the_py_module = importlib.import_module(py_module_name)
+        except ImportError:
+            return TOOLS_FILE_NOT_FOUND
+        except:
+            sys.excepthook(*sys.exc_info())
+            return TOOLS_MODULE_TRACEBACK
+    return TOOLS_SUCCESS
 
-    # Need to figure out now which modules are being imported from any of the paths...
+def _find_imported_paths(module_paths):
+    """Gets a list of the source files for all loaded modules from any of the paths"""
+    result = []
     for module in sys.modules.values():
         try:
             this_module_path = inspect.getsourcefile(module)
@@ -60,9 +67,77 @@ def get_imports(py_module_name, *module_paths):
 
             for module_search_path in module_paths:
                 if os.path.commonprefix([module_search_path, this_module_path]):
-                    sys.stdout.write(this_module_path)
-                    sys.stdout.write("\n")
+                    result.append(this_module_path)
                     break
+    return result
+
+def get_imports(py_module_name, *module_paths):
+    """Gets a list of non-system imports"""
+
+    # This could be done in an environment variable, but that seems kind of nasty.
+    sys.path.extend(module_paths)
+
+    result = _import_module(py_module_name)
+    if result != TOOLS_SUCCESS:
+        sys.exit(result)
+
+    # Need to figure out now which modules are being imported from any of the paths...
+    for this_module_path in _find_imported_paths(module_paths):
+        sys.stdout.write(this_module_path)
+        sys.stdout.write("\n")
+
+def serve(*module_paths):
+    """Resolves the imports of each module name read from stdin until stdin is closed.
+       Each response is a series of lines tagged "M" for an imported module path or "E" for
+       any output produced by the module, followed by "R" and the TOOLS_* result code.
+    """
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+
+    sys.path.extend(module_paths)
+    stdout = sys.stdout
+    stderr = sys.stderr
+    baseline_modules = sys.modules.copy()
+    baseline_path = sys.path[:]
+
+    while 1:
+        py_module_name = sys.stdin.readline()
+        if not py_module_name:
+            break
+        py_module_name = py_module_name.strip()
+        if not py_module_name:
+            continue
+
+        module_paths_found = []
+        capture = StringIO()
+        sys.stdout = capture
+        sys.stderr = capture
+        try:
+            try:
+                result = _import_module(py_module_name)
+                if result == TOOLS_SUCCESS:
+                    module_paths_found = _find_imported_paths(module_paths)
+            except:
+                sys.excepthook(*sys.exc_info())
+                result = TOOLS_CRASHED
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+
+        for this_module_path in module_paths_found:
+            stdout.write("M %s\n" % this_module_path)
+        for line in capture.getvalue().splitlines():
+            stdout.write("E %s\n" % line)
+        stdout.write("R %d\n" % result)
+        stdout.flush()
+
+        # Forget everything the module imported so the next request is resolved from scratch.
+        for name in list(sys.modules.keys()):
+            if name not in baseline_modules:
+                del sys.modules[name]
+        sys.path[:] = baseline_path
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -13,16 +13,48 @@
 #    You should have received a copy of the GNU General Public License
 #    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import gzip
 import hashlib
 import logging
+import mmap
+import os
 import pathlib
 import shutil
 import signal
 import subprocess
 import sys
+import threading
 import zipfile
+import zlib
+from _constants import LinkMode
+import _py2constants
 
 _BUFFER_SIZE = 10 * 1024 * 1024
+_HASH_CHUNK_SIZE = 256 * 1024
+
+# Files in these formats are already compressed, so deflating them again is a waste of time.
+_precompressed_extensions = {
+    ".7z", ".avi", ".bik", ".cab", ".gz", ".jpeg", ".jpg", ".mp3", ".msi", ".ogg", ".png", ".webm", ".zip",
+}
+_ENTROPY_SAMPLE_SIZE = 64 * 1024
+_ENTROPY_SAMPLE_RATIO = 0.9
+# Larger members are deflated by zipfile while the archive is locked rather than held in memory.
+_ZIP_MAX_PARALLEL_SIZE = 64 * 1024 * 1024
+# Appending members that were deflated outside of the lock relies on ZipFile internals that are
+# the same in every CPython from 3.8 through 3.13. Anywhere else, zipfile deflates everything
+# itself while the archive is locked.
+_ZIP_RAW_APPEND = sys.implementation.name == "cpython" and (3, 8) <= sys.version_info[:2] <= (3, 13)
+
+@functools.lru_cache(maxsize=None)
+def _log_zip_fallback():
+    logging.warning(f"Zip members are compressed one at a time on {sys.implementation.name} "
+                    f"{sys.version_info.major}.{sys.version_info.minor}, so zip output will be slower.")
+
+_hash_algorithms = {
+    "hash_md5": hashlib.md5,
+    "hash_sha2": hashlib.sha512,
+}
 
 def find_python_exe(major=2, minor=7):
     def _find_python_reg(py_version):
@@ -70,22 +102,98 @@ def find_python2_tools():
     tools_path = pathlib.Path(__file__).parent.joinpath("_py2tools.py")
     return tools_path
 
-def _hash(path, hashobj):
-    stat = path.stat()
-    with open(path, "rb") as stream:
-        if stat.st_size < _BUFFER_SIZE:
-            hashobj.update(stream.read())
+class PyToolsServer:
+    """A long-running Python 2 interpreter that resolves the imports of modules on request."""
+
+    def __init__(self, py_exe, *module_paths):
+        self._args = (str(py_exe), str(find_python2_tools()), "serve", *(str(i) for i in module_paths))
+        self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def close(self, kill=False):
+        """Stops the interpreter. If `kill`, it is stopped even if it is in the middle of a request."""
+        if self._proc is not None:
+            if kill:
+                self._proc.kill()
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc = None
+
+    def get_imports(self, module_name):
+        """Returns the result code, module paths imported, and any output from importing `module_name`."""
+        # Restart the interpreter if some module managed to kill it.
+        if self._proc is None or self._proc.poll() is not None:
+            self.close()
+            self._proc = subprocess.Popen(self._args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          encoding="utf-8", errors="replace", bufsize=1)
+
+        module_paths, output = [], []
+        try:
+            self._proc.stdin.write(f"{module_name}\n")
+            self._proc.stdin.flush()
+            for line in self._proc.stdout:
+                tag, _, value = line.rstrip("\n").partition(" ")
+                if tag == "M":
+                    module_paths.append(value)
+                elif tag == "E":
+                    output.append(value)
+                elif tag == "R":
+                    return int(value), module_paths, "\n".join(output)
+        except BrokenPipeError:
+            pass
+        except:
+            # Whatever is left of the response would be read as the answer to the next request.
+            self.close(kill=True)
+            raise
+        # The interpreter died partway through, so don't leave it to answer the next request.
+        self.close(kill=True)
+        return _py2constants.TOOLS_CRASHED, module_paths, "\n".join(output)
+
+def _hash(path, *hashobjs):
+    """Feeds the contents of the file given by `path` into each of `hashobjs` in a single pass."""
+    with open(path, "rb", buffering=0) as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if size < _BUFFER_SIZE:
+            data = stream.read()
+            for hashobj in hashobjs:
+                hashobj.update(data)
         else:
-            buf = bytearray(_BUFFER_SIZE)
-            while stream.readinto(buf):
-                hashobj.update(buf)
-    return hashobj.hexdigest()
+            # Large files are mapped into memory so the digests can read straight out of the page
+            # cache. They are fed in small-ish slices so that each slice is still hot in the CPU
+            # cache when the next digest gets to it.
+            with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                with memoryview(mapping) as view:
+                    for offset in range(0, size, _HASH_CHUNK_SIZE):
+                        with view[offset:offset+_HASH_CHUNK_SIZE] as chunk:
+                            for hashobj in hashobjs:
+                                hashobj.update(chunk)
+    return hashobjs
+
+def hash_file(path, prefix=""):
+    """Computes all of the digests the asset format knows about for the file given by `path`,
+       reading the file only once. The result maps the asset dict keys (with an optional `prefix`,
+       eg "compressed_") to the hex digests.
+    """
+    hashobjs = _hash(path, *(i() for i in _hash_algorithms.values()))
+    return { f"{prefix}{key}": hashobj.hexdigest() for key, hashobj in zip(_hash_algorithms.keys(), hashobjs) }
 
 def hash_md5(path):
-    return _hash(path, hashlib.md5())
+    md5, = _hash(path, hashlib.md5())
+    return md5.hexdigest()
 
 def hash_sha2(path):
-    return _hash(path, hashlib.sha512())
+    sha2, = _hash(path, hashlib.sha512())
+    return sha2.hexdigest()
 
 def merge_options(target_asset, other_assets):
     options = set(target_asset.get("options", []))
@@ -99,19 +207,136 @@ def multiprocess_init():
     logging.basicConfig(format="[%(asctime)s] %(levelname)s: %(message)s")
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+def stat_file(path):
+    """Returns the `os.stat_result` of the file given by `path`, or None if it does not exist."""
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
+
+def list_files(path):
+    """Returns the sorted paths of the files in the directory given by `path`, not including its
+       subdirectories, or nothing if it does not exist.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return sorted(path.joinpath(i.name) for i in entries if i.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
 def win_path_str(*pathsegments):
     return str(pathlib.PureWindowsPath(*pathsegments))
 
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+def hardlink_file(source_path, dest_path):
+    """Hardlinks `dest_path` to `source_path`. Returns False if the filesystem can't."""
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        return False
+    return True
+
+def reflink_file(source_path, dest_path):
+    """Makes `dest_path` a copy-on-write clone of `source_path`. Returns False if the filesystem
+       can't.
+    """
+    if sys.platform != "linux":
+        return False
+
+    import fcntl
+    with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            pass
+        else:
+            shutil.copystat(source_path, dest_path)
+            return True
+    os.unlink(dest_path)
+    return False
+
+def link_file(source_path, dest_path):
+    """Makes `dest_path` share the contents of `source_path` using a hardlink or, failing that, a
+       reflink. Returns False if the filesystem supports neither.
+    """
+    return hardlink_file(source_path, dest_path) or reflink_file(source_path, dest_path)
+
+def fast_copy_file(source_path, dest_path):
+    """Copies a file and its metadata, letting the kernel copy the data where it can."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+        except OSError:
+            # Not supported between these filesystems, eg on older kernels.
+            pass
+        else:
+            if not remaining:
+                shutil.copystat(source_path, dest_path)
+                return
+    shutil.copy2(source_path, dest_path)
+
+def is_compressible(path):
+    """Guesses whether deflating the file given by `path` is worth the trouble, either from its
+       extension or by test compressing a sample of the file.
+    """
+    if path.suffix.lower() in _precompressed_extensions:
+        return False
+    with open(path, "rb") as stream:
+        sample = stream.read(_ENTROPY_SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * _ENTROPY_SAMPLE_RATIO
+
+def gzip_file(source_path, dest_path, min_savings=0.0):
+    """Writes a gzipped copy of the file given by `source_path` to `dest_path`. Returns the size
+       and digests of the copy as "compressed_" asset dict keys, or None if compressing does not
+       shrink the file by at least the fraction `min_savings`.
+    """
+    if not is_compressible(source_path):
+        return None
+
+    # No timestamp, so that the digests are stable from one run to the next.
+    with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=dst, mtime=0) as stream:
+            shutil.copyfileobj(src, stream, _BUFFER_SIZE)
+
+    size = os.stat(source_path).st_size
+    compressed_size = os.stat(dest_path).st_size
+    if compressed_size > size * (1.0 - min_savings):
+        os.unlink(dest_path)
+        return None
+
+    result = hash_file(dest_path, "compressed_")
+    result["compressed_size"] = compressed_size
+    return result
+
 class OutputManager:
-    def __init__(self, path):
+    def __init__(self, path, dedup=False, link_mode=LinkMode.copy):
         self._is_zip = path.suffix == ".zip"
         self._path = path
 
+        # When deduplicating, the first copy of each file body (keyed by its SHA-512) is the one
+        # stored copy that every other path with the same contents is linked to.
+        self._dedup = dedup and not self._is_zip
+        self._link_mode = link_mode
+        self._bodies = {}
+        self._bodies_lock = threading.Lock()
+
         parent = path.parent
         if not parent.exists():
             parent.mkdir(parents=True)
         if self._is_zip:
             self._zip = zipfile.ZipFile(path, compression=zipfile.ZIP_DEFLATED, mode="w")
+            # Files may be copied from several threads, but only one member can be written at once.
+            self._zip_lock = threading.Lock()
+            if not _ZIP_RAW_APPEND:
+                _log_zip_fallback()
 
     def __enter__(self):
         return self
@@ -121,32 +346,139 @@ class OutputManager:
             self._zip.close()
         return False
 
-    def copy_file(self, source_path, dest_path):
-        """Copies a file given by the absolute `source_path` to the relative `dest_path`."""
+    def copy_file(self, source_path, dest_path, hash_sha2=None):
+        """Copies a file given by the absolute `source_path` to the relative `dest_path`. If the
+           SHA-512 of the file is given and deduplication is enabled, files with identical
+           contents are linked together instead of copied. For directory output, the link mode
+           decides whether the destination may be linked to the source instead of copied.
+        """
         if self._is_zip:
-            self._zip.write(source_path, dest_path)
-        else:
-            shutil.copy2(source_path, self._get_fs_path(dest_path))
+            self._write_zip_member(source_path, dest_path)
+            return
+
+        fs_path = self.get_fs_path(dest_path)
+        # The destination may be linked to other files from a previous build, so never write
+        # through it.
+        fs_path.unlink(missing_ok=True)
+        if not self._dedup or hash_sha2 is None:
+            self._copy(source_path, fs_path)
+            return
 
-    def _get_fs_path(self, path):
+        with self._bodies_lock:
+            body_path, body_lock = self._bodies.setdefault(hash_sha2, (fs_path, threading.Lock()))
+        # Anyone else with the same contents waits until the stored copy has been written.
+        with body_lock:
+            if body_path == fs_path or not body_path.exists() or not link_file(body_path, fs_path):
+                self._copy(source_path, fs_path)
+
+    def _copy(self, source_path, fs_path):
+        if self._link_mode in {LinkMode.hardlink, LinkMode.auto} and hardlink_file(source_path, fs_path):
+            return
+        if self._link_mode in {LinkMode.reflink, LinkMode.auto} and reflink_file(source_path, fs_path):
+            return
+        fast_copy_file(source_path, fs_path)
+
+    def is_identical(self, source_path, dest_path, size=None, hash_sha2=None):
+        """Determines if the file at the relative `dest_path` is already the same as `source_path`,
+           either because it is the same file or because it has the expected size and SHA-512.
+        """
+        stat = self.stat(dest_path)
+        if stat is None or (size is not None and stat.st_size != size):
+            return False
+        if os.path.samestat(stat, os.stat(source_path)):
+            return True
+        if hash_sha2 is None:
+            return False
+        sha2, = _hash(self._path.joinpath(dest_path), hashlib.sha512())
+        return sha2.hexdigest() == hash_sha2
+
+    def _write_zip_member(self, source_path, dest_path):
+        zinfo = zipfile.ZipInfo.from_file(source_path, dest_path)
+        compressible = is_compressible(source_path)
+        if not compressible or zinfo.file_size > _ZIP_MAX_PARALLEL_SIZE or not _ZIP_RAW_APPEND:
+            compress_type = zipfile.ZIP_DEFLATED if compressible else zipfile.ZIP_STORED
+            with self._zip_lock:
+                self._zip.write(source_path, dest_path, compress_type=compress_type)
+            return
+
+        # Deflate the member in the calling thread (zlib releases the GIL), so that many
+        # members are compressed at once, and only lock the archive to append the result.
+        with open(source_path, "rb") as stream:
+            data = stream.read()
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = len(data)
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = zlib.crc32(data)
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+        with self._zip_lock:
+            self._append_zip_member(zinfo, compressed)
+
+    def _append_zip_member(self, zinfo, compressed):
+        # This mirrors what ZipFile.write() does, minus the compression. Only used in the
+        # versions covered by `_ZIP_RAW_APPEND`, which the tests check.
+        self._zip.fp.seek(self._zip.start_dir)
+        zinfo.header_offset = self._zip.fp.tell()
+        self._zip._writecheck(zinfo)
+        self._zip._didModify = True
+        self._zip.fp.write(zinfo.FileHeader(False))
+        self._zip.fp.write(compressed)
+        self._zip.start_dir = self._zip.fp.tell()
+        self._zip.filelist.append(zinfo)
+        self._zip.NameToInfo[zinfo.filename] = zinfo
+
+    def add_existing_file(self, path, hash_sha2):
+        """Allows the file already at the relative `path` to be linked to by later copies."""
+        if self._dedup:
+            with self._bodies_lock:
+                self._bodies.setdefault(hash_sha2, (self._path.joinpath(path), threading.Lock()))
+
+    @property
+    def dedup(self):
+        return self._dedup
+
+    def get_fs_path(self, path):
+        """Returns where the relative `path` lives on disk, creating its directory if needed."""
+        assert not self._is_zip
         dest_path = self._path.joinpath(path)
-        parent = dest_path.parent
-        if not parent.exists():
-            parent.mkdir(parents=True)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
         return dest_path
 
     @property
     def is_zip(self):
         return self._is_zip
 
+    def remove_file(self, path):
+        """Removes the file given by the relative `path` and any directories left empty."""
+        assert not self._is_zip
+        fs_path = self._path.joinpath(path)
+        fs_path.unlink(missing_ok=True)
+        for parent in fs_path.parents:
+            if parent == self._path or any(parent.iterdir()):
+                break
+            parent.rmdir()
+
+    def stat(self, path):
+        """Returns the `os.stat_result` of the file at the relative `path` or None if it does not exist."""
+        if self._is_zip:
+            # Only meaningful when we've already written the file.
+            return None
+        try:
+            return self._path.joinpath(path).stat()
+        except FileNotFoundError:
+            return None
+
     def open(self, path, mode):
         if self._is_zip:
             return self._zip.open(str(path), mode)
         else:
-            return open(self._get_fs_path(path), mode)
+            return open(self.get_fs_path(path), mode)
 
     def write_file(self, path, data):
         if self._is_zip:
-            self._zip.writestr(str(path), data)
+            with self._zip_lock:
+                self._zip.writestr(str(path), data)
         else:
-            self._get_fs_path(path).write_text(data)
+            self.get_fs_path(path).write_text(data)
@@ -0,0 +1,173 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+from ruamel.yaml import YAML
+
+from _constants import *
+import logging
+from pathlib import Path, PureWindowsPath
+import diff
+import merge
+import _index
+import _utils
+
+# Where new assets that the patch doesn't list in any subpackage end up in a database with subpackages.
+_added_subpackage = { "name": "Patches", "source": "patches.yml" }
+
+def _walk_packages(bundles, source_path="contents.yml", subpackage_name=None):
+    bundle = bundles[source_path]
+    yield subpackage_name, source_path, bundle
+    for i in bundle.get("subpackages", []):
+        yield from _walk_packages(bundles, i["source"], i["name"])
+
+def _asset_files(base_path, asset_dict):
+    for key in ("source", "compressed_source"):
+        if key in asset_dict:
+            yield Path(*PureWindowsPath(base_path, asset_dict[key]).parts)
+
+def _load_tombstones(removed_path):
+    tombstones = YAML(typ="safe").load(removed_path) if removed_path.exists() else None
+    removed = set()
+    for asset_category, assets in (tombstones or {}).items():
+        for i in assets:
+            # Artifacts are listed along with the architecture they were built for.
+            if isinstance(i, dict):
+                removed.add(merge.asset_key(asset_category, i["filename"], i.get("arch")))
+            else:
+                removed.add(merge.asset_key(asset_category, i))
+    return removed
+
+def apply_patch(database_path, patch_path, link_mode=LinkMode.copy, jobs=None):
+    """Updates the asset database given by `database_path` in place with a patch package written
+       by the diff command. Changed assets are written over the old copies in every package that
+       lists them, removed assets are dropped, and new assets are added to the subpackages that
+       list them in the patch.
+    """
+    patch_options = {}
+    patch = merge.load_asset_db(patch_path, jobs, patch_options)
+    merge.reduce_db(patch)
+    removed = _load_tombstones(patch_path.joinpath(diff.REMOVED_FILENAME))
+
+    bundles = merge.load_bundles(database_path, jobs)
+    packages = list(_walk_packages(bundles))
+    dropped, placed, modified = set(), set(), set()
+
+    def place_asset(base_path, subpackage_name, key, asset_dict):
+        record = patch[key]
+        asset = record.asset
+        result = asset.to_dict()
+        # The reduced asset has every subpackage's options, so use the ones meant for this package.
+        if (subpackage_name, key) in patch_options:
+            options = patch_options[(subpackage_name, key)]
+        else:
+            options = asset_dict.get("options") if asset_dict else asset.options
+        if options:
+            result["options"] = list(options)
+        else:
+            result.pop("options", None)
+
+        source = asset_dict.get("source", _utils.win_path_str(asset_subdirectories[key[0]], record.filename))
+        compressed_source = None
+        if asset.compressed_source is not None:
+            compressed_source = asset_dict.get("compressed_source", f"{source}{PureWindowsPath(asset.compressed_source).suffix}")
+        elif "compressed_source" in asset_dict:
+            # The old compressed copy doesn't match the new asset.
+            dropped.update(_asset_files(base_path, { "compressed_source": asset_dict["compressed_source"] }))
+
+        for source_key, dest, size, hash_sha2 in (("source", source, asset.size, asset.hash_sha2),
+                                                  ("compressed_source", compressed_source, asset.compressed_size, asset.compressed_hash_sha2)):
+            if dest is None:
+                continue
+            asset_source_path = patch_path.joinpath(*PureWindowsPath(getattr(asset, source_key)).parts)
+            asset_dest_path, = _asset_files(base_path, { source_key: dest })
+            if not outfile.is_identical(asset_source_path, asset_dest_path, size, hash_sha2.hex() if hash_sha2 else None):
+                logging.debug(f"Copying '{asset_source_path}' to '{asset_dest_path}'")
+                outfile.copy_file(asset_source_path, asset_dest_path)
+            result[source_key] = dest
+        return result
+
+    def find_package(subpackage_name):
+        subpackage = dict(_added_subpackage) if subpackage_name is None else \
+                     { "name": subpackage_name, "source": f"{subpackage_name}.yml" }
+        for i in packages[1:]:
+            if i[0] == subpackage["name"]:
+                return i
+        logging.debug(f"Adding subpackage '{subpackage['name']}'")
+        bundles["contents.yml"]["subpackages"].append(subpackage)
+        bundles[subpackage["source"]] = {}
+        packages.append((subpackage["name"], subpackage["source"], bundles[subpackage["source"]]))
+        modified.add("contents.yml")
+        return packages[-1]
+
+    with _utils.OutputManager(database_path, link_mode=link_mode) as outfile:
+        logging.info("Applying patch...")
+        for subpackage_name, yaml_path, bundle in packages:
+            base_path = PureWindowsPath(yaml_path).parent
+            for asset_category, assets in tuple(bundle.items()):
+                if asset_category == "subpackages":
+                    continue
+                for asset_filename, asset_dict in tuple(assets.items()):
+                    key = merge.asset_key(asset_category, asset_filename, asset_dict.get("arch"))
+                    if key in removed:
+                        dropped.update(_asset_files(base_path, asset_dict))
+                        del assets[asset_filename]
+                        modified.add(yaml_path)
+                    elif key in patch:
+                        assets[asset_filename] = place_asset(base_path, subpackage_name, key, asset_dict)
+                        placed.add(key)
+                        modified.add(yaml_path)
+                if not assets:
+                    del bundle[asset_category]
+
+        added = [key for key in patch.keys() if key not in placed]
+        for key in added:
+            record = patch[key]
+            # Databases with subpackages aren't supposed to have assets at the top level, so new
+            # assets go in the same subpackages as in the patch.
+            if "subpackages" in bundles["contents.yml"]:
+                add_to = [find_package(i) for i in record.subpackages or (None,)]
+            else:
+                add_to = [packages[0]]
+            for subpackage_name, yaml_path, bundle in add_to:
+                asset_dict = place_asset(PureWindowsPath(yaml_path).parent, subpackage_name, key, {})
+                bundle.setdefault(key[0], {})[record.filename] = asset_dict
+                modified.add(yaml_path)
+
+        # Only delete the files of the dropped assets that nothing else uses.
+        referenced = { i for _, yaml_path, bundle in packages
+                       for asset_category, assets in bundle.items() if asset_category != "subpackages"
+                       for asset_dict in assets.values()
+                       for i in _asset_files(PureWindowsPath(yaml_path).parent, asset_dict) }
+        for i in sorted(dropped - referenced):
+            logging.debug(f"Removing '{i}'")
+            outfile.remove_file(i)
+
+        logging.info(f"Applied {len(placed)} changed, {len(added)} added, and {len(removed)} removed assets.")
+        yaml = YAML()
+        for yaml_path in sorted(modified):
+            # Sources are written with Windows separators, which aren't separators everywhere.
+            with outfile.open(Path(*PureWindowsPath(yaml_path).parts), "w") as stream:
+                yaml.dump(bundles[yaml_path], stream)
+        _index.write_index(outfile, [(subpackage_name, yaml_path, { key: value for key, value in bundle.items() if key != "subpackages" })
+                                     for subpackage_name, yaml_path, bundle in packages])
+
+def main(args):
+    for source_path in (args.database, args.patch):
+        if not source_path.is_dir():
+            logging.error(f"Path '{source_path}' must be an existing directory.")
+            return False
+
+    apply_patch(args.database, args.patch, args.link_mode, args.jobs)
+    return True
@@ -0,0 +1,108 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+from ruamel.yaml import YAML
+
+import logging
+import multiprocessing, multiprocessing.pool
+from pathlib import PureWindowsPath
+import merge
+import _utils
+
+REMOVED_FILENAME = "removed.yml"
+
+# Keys that describe where a copy of the asset lives rather than the asset itself.
+_location_keys = frozenset(("source", "compressed_source", "compressed_size", "compressed_hash_md5",
+                            "compressed_hash_sha2", "modify_time"))
+
+def _asset_metadata(asset):
+    return { key: value for key, value in asset.to_dict().items() if key not in _location_keys }
+
+def _compare_assets(old_asset, new_asset):
+    """Returns whether the asset has changed, or None if that can't be told without reading it."""
+    for hash_key in ("hash_sha2", "hash_md5"):
+        old_hash, new_hash = getattr(old_asset, hash_key), getattr(new_asset, hash_key)
+        if old_hash is not None and new_hash is not None:
+            return old_hash != new_hash or _asset_metadata(old_asset) != _asset_metadata(new_asset)
+    if old_asset.size is not None and new_asset.size is not None and old_asset.size != new_asset.size:
+        return True
+    return None
+
+def diff_db(old_database, old_path, new_database, new_path, jobs=None):
+    """Compares two reduced asset databases. Returns a tuple of the keys of the assets that were
+       added or changed in `new_database` and the keys of the assets that were removed from it.
+       Files are only read when the databases lack the digests to compare them.
+    """
+    changed, unknown = [], []
+    for key, record in new_database.items():
+        old_record = old_database.get(key)
+        result = _compare_assets(old_record.asset, record.asset) if old_record is not None else True
+        if result is None:
+            unknown.append(key)
+        elif result:
+            changed.append(key)
+
+    if unknown:
+        logging.info(f"Hashing {len(unknown)} assets without comparable digests...")
+        paths = [(old_path.joinpath(*PureWindowsPath(old_database[i].asset.source).parts),
+                  new_path.joinpath(*PureWindowsPath(new_database[i].asset.source).parts))
+                 for i in unknown]
+        pool = multiprocessing.pool.Pool(jobs, initializer=_utils.multiprocess_init)
+        try:
+            results = pool.map(_utils.hash_sha2, (i for pair in paths for i in pair), chunksize=16)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        else:
+            pool.close()
+            pool.join()
+        for i, key in enumerate(unknown):
+            if results[i * 2] != results[i * 2 + 1] or \
+               _asset_metadata(old_database[key].asset) != _asset_metadata(new_database[key].asset):
+                changed.append(key)
+
+    removed = [key for key in old_database.keys() if key not in new_database]
+    return changed, removed
+
+def main(args):
+    for source_path in (args.old, args.new):
+        if not source_path.is_dir():
+            logging.error(f"Source path '{source_path}' must be an existing directory.")
+            return False
+
+    old_database = merge.load_asset_db(args.old, args.jobs)
+    merge.reduce_db(old_database)
+    new_options = {}
+    new_database = merge.load_asset_db(args.new, args.jobs, new_options)
+    merge.reduce_db(new_database)
+
+    logging.info("Comparing databases...")
+    changed, removed = diff_db(old_database, args.old, new_database, args.new, args.jobs)
+    logging.info(f"{len(changed)} assets were added or changed, {len(removed)} were removed.")
+
+    patch = { key: new_database[key] for key in sorted(changed) }
+    tombstones = {}
+    for asset_category, asset_filename, arch in sorted(removed):
+        filename = old_database[(asset_category, asset_filename, arch)].filename
+        tombstones.setdefault(asset_category, []).append({ "filename": filename, "arch": arch } if arch else filename)
+
+    # The patch keeps the subpackages of the new database, so that apply knows where new assets go.
+    preserve_subpackages = any(record.subpackages for record in new_database.values())
+    with _utils.OutputManager(args.destination, link_mode=args.link_mode) as outfile:
+        merge.write_db(patch, args.new, outfile, preserve_subpackages, new_options)
+        with outfile.open(REMOVED_FILENAME, "w") as stream:
+            YAML().dump(tombstones, stream)
+    return True
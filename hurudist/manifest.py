@@ -0,0 +1,220 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+from _constants import *
+import logging
+import multiprocessing, multiprocessing.pool
+from pathlib import Path, PureWindowsPath
+import merge
+import _utils
+
+# Asset options that are passed along to the client as FileSrv manifest flags.
+_option_flags = {
+    "sound_cache_split": ManifestFlags.sound_cache_split,
+    "sound_stream": ManifestFlags.sound_stream_compressed,
+    "sound_cache_stereo": ManifestFlags.sound_cache_stereo,
+    "redist": ManifestFlags.redist_update,
+}
+
+# Categories whose assets are only needed by the client once it is linking to an age.
+_age_categories = frozenset(("avi", "data", "sfx"))
+
+
+class ManifestEntry:
+    __slots__ = ("client_path", "download_path", "hash_md5", "download_hash_md5", "size", "download_size", "flags")
+
+    def __str__(self):
+        return ",".join((self.client_path, self.download_path, self.hash_md5, self.download_hash_md5,
+                         str(self.size), str(self.download_size), str(int(self.flags))))
+
+
+def is_distributable(asset):
+    distribute = asset.distribute
+    if distribute is None:
+        # Cyan's assets are not ours to hand out unless someone says otherwise.
+        distribute = "false" if (asset.dataset or "").lower() == "cyan" else "true"
+    return Distribute[str(distribute).lower()] != Distribute.false
+
+def is_client_package(subpackage_name):
+    return subpackage_name == "Client" or subpackage_name.startswith("Client-")
+
+def is_wanted_artifact(asset, client_os, client_arch):
+    extra = asset.extra or {}
+    return extra.get("os", str(client_os)) == str(client_os) and extra.get("arch", str(client_arch)) == str(client_arch)
+
+def filter_artifacts(database, client_os, client_arch):
+    """Drops every copy of an artifact that was built for another client from the unreduced
+       database, so that other clients' builds are never weighed against the wanted one.
+    """
+    nuke = []
+    for key, record in database.items():
+        if key[0] == "artifacts":
+            record.versions = [i for i in record.versions if is_wanted_artifact(i, client_os, client_arch)]
+            if not record.versions:
+                nuke.append(key)
+    for i in nuke:
+        del database[i]
+
+def prepare_downloads(database, source_path, outfile, jobs=None):
+    """Places a download of each asset in the FileSrv tree and returns a dict mapping each
+       database key to its `ManifestEntry`. Compressed copies already in the database are reused,
+       and any that are missing are made in a process pool. Assets are only read if the database
+       lacks their digests.
+    """
+    entries = {}
+    pending = []
+    for key, record in database.items():
+        asset, asset_category = record.asset, key[0]
+        client_path = _utils.win_path_str(client_subdirectories[asset_category], record.filename)
+        download_path = Path(*PureWindowsPath(client_path).parts)
+        entry = entries[key] = ManifestEntry()
+        entry.client_path = client_path
+        entry.flags = ManifestFlags(0)
+        for i in asset.options or ():
+            entry.flags |= _option_flags.get(i, 0)
+        entry.size = asset.size
+        entry.hash_md5 = asset.hash_md5.hex() if asset.hash_md5 is not None else None
+
+        asset_source_path = source_path.joinpath(*PureWindowsPath(asset.source).parts)
+        compression = (asset.extra or {}).get("compression", "gzip")
+        if asset.compressed_source is not None and asset.compressed_hash_md5 is not None and \
+           asset.compressed_size is not None and compression == "gzip":
+            compressed_path = download_path.with_name(f"{download_path.name}.gz")
+            compressed_source_path = source_path.joinpath(*PureWindowsPath(asset.compressed_source).parts)
+            compressed_hash_sha2 = asset.compressed_hash_sha2.hex() if asset.compressed_hash_sha2 is not None else None
+            if not outfile.is_identical(compressed_source_path, compressed_path, asset.compressed_size,
+                                        compressed_hash_sha2):
+                outfile.copy_file(compressed_source_path, compressed_path)
+            _set_download(entry, compressed_path, asset.compressed_hash_md5.hex(), asset.compressed_size)
+            if entry.hash_md5 is None or entry.size is None:
+                pending.append((key, asset_source_path, None, False))
+        else:
+            # The packager already decided that this asset is not worth compressing.
+            pending.append((key, asset_source_path, download_path, compression != "none"))
+
+    logging.info(f"Preparing {len(pending)} downloads...")
+    pool = multiprocessing.pool.Pool(jobs, initializer=_utils.multiprocess_init)
+    try:
+        # The results are consumed in order so the copies of assets that won't compress
+        # are made while the pool is still busy with the rest.
+        args = [(source, outfile.get_fs_path(dest.with_name(f"{dest.name}.gz")) if dest and gzip else None,
+                 entries[key].hash_md5 is None or entries[key].size is None)
+                for key, source, dest, gzip in pending]
+        results = pool.imap(_prepare_download, args, chunksize=8)
+        for (key, asset_source_path, download_path, _), (size, hashes, compressed) in zip(pending, results):
+            entry = entries[key]
+            entry.size = size
+            if hashes is not None:
+                entry.hash_md5 = hashes["hash_md5"]
+            if download_path is None:
+                continue
+            if compressed is not None:
+                _set_download(entry, download_path.with_name(f"{download_path.name}.gz"),
+                              compressed["compressed_hash_md5"], compressed["compressed_size"])
+            else:
+                hash_sha2 = database[key].asset.hash_sha2
+                if not outfile.is_identical(asset_source_path, download_path, size,
+                                            hash_sha2.hex() if hash_sha2 is not None else None):
+                    outfile.copy_file(asset_source_path, download_path)
+                _set_download(entry, download_path, entry.hash_md5, size, zipped=False)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+    return entries
+
+def _set_download(entry, download_path, hash_md5, size, zipped=True):
+    entry.download_path = _utils.win_path_str(download_path)
+    entry.download_hash_md5 = hash_md5
+    entry.download_size = size
+    if zipped:
+        entry.flags |= ManifestFlags.zipped
+
+def _prepare_download(args):
+    source_path, gzip_path, need_hashes = args
+    size = source_path.stat().st_size
+    hashes = _utils.hash_file(source_path) if need_hashes else None
+    compressed = None
+    if gzip_path is not None:
+        # The old copy may be linked to something else, so never write through it.
+        gzip_path.unlink(missing_ok=True)
+        compressed = _utils.gzip_file(source_path, gzip_path)
+    return size, hashes, compressed
+
+def find_manifests(database, client_os, client_arch):
+    """Sorts the database keys into the FileSrv manifests, returning a dict mapping each manifest
+       name to its keys. Undistributable assets and artifacts for other clients are left out.
+    """
+    manifests = {}
+    for key, record in database.items():
+        asset, asset_category = record.asset, key[0]
+        if not is_distributable(asset):
+            logging.debug(f"Asset ('{asset_category}', '{record.filename}') is not distributable, skipping.")
+            continue
+
+        if asset_category == "artifacts":
+            if not is_wanted_artifact(asset, client_os, client_arch):
+                continue
+            if "redist" in (asset.options or ()):
+                manifests.setdefault("DependencyPatcher", []).append(key)
+                continue
+            build_type = (asset.extra or {}).get("build_type")
+            for i in ("External", "Internal"):
+                if build_type is None or build_type == i.lower():
+                    manifests.setdefault(f"Thin{i}", []).append(key)
+                    manifests.setdefault(i, []).append(key)
+        elif asset_category in _age_categories:
+            for i in ("External", "Internal"):
+                manifests.setdefault(i, []).append(key)
+            for i in record.subpackages:
+                if not is_client_package(i):
+                    manifests.setdefault(i, []).append(key)
+        else:
+            manifests.setdefault("SecurePreloader", []).append(key)
+    return manifests
+
+def write_manifests(manifests, entries, outfile):
+    for manifest_name, keys in sorted(manifests.items()):
+        logging.debug(f"Writing manifest '{manifest_name}'...")
+        lines = sorted(str(entries[i]) for i in keys)
+        outfile.write_file(f"{manifest_name}.mfs", "".join(f"{i}\n" for i in lines))
+
+def main(args):
+    source_path = args.source
+    if not source_path.exists():
+        logging.error(f"Source path '{source_path}' does not exist.")
+        return False
+    if not source_path.is_dir():
+        logging.error(f"Source path '{source_path}' must be a directory.")
+        return False
+    if args.destination.suffix == ".zip":
+        logging.error(f"Destination path '{args.destination}' must be a directory.")
+        return False
+
+    database = merge.load_asset_db(source_path, args.jobs)
+    filter_artifacts(database, args.client_os, args.client_arch)
+    merge.reduce_db(database)
+    manifests = find_manifests(database, args.client_os, args.client_arch)
+    wanted = {i for keys in manifests.values() for i in keys}
+    database = { key: record for key, record in database.items() if key in wanted }
+
+    with _utils.OutputManager(args.destination, link_mode=args.link_mode) as outfile:
+        entries = prepare_downloads(database, source_path, outfile, args.jobs)
+        logging.info(f"Writing {len(manifests)} manifests...")
+        write_manifests(manifests, entries, outfile)
+    return True
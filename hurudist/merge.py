@@ -18,8 +18,15 @@ from ruamel.yaml import YAML
 from _constants import *
 import copy
 import functools
+import itertools
 import logging
-from pathlib import Path
+import multiprocessing, multiprocessing.pool
+import os
+from pathlib import Path, PureWindowsPath
+import sys
+import _cache
+import _index
+import _profile
 import _utils
 
 class MalformedPackageError(Exception):
@@ -31,22 +38,156 @@ class PackageSanityError(Exception):
     pass
 
 
-def load_asset_db(source_path):
-    """Loads the asset database given by source path as a dict, mapping (asset_category, asset_filename)
-       to a dict containing a set of subpackage names and asset dicts. NOTE: this is a destructive
-       operation and will not return the data as-is on disk.
+class AssetVersion:
+    """A single package's copy of an asset. Digests are held as bytes and the strings that repeat
+       between assets (datasets, options, etc.) are interned, so that whole shards fit in memory.
+    """
+
+    __slots__ = ("source", "compressed_source", "dataset", "distribute", "size", "compressed_size", "modify_time",
+                 "hash_md5", "hash_sha2", "compressed_hash_md5", "compressed_hash_sha2", "options", "extra")
+
+    _hash_keys = frozenset(("hash_md5", "hash_sha2", "compressed_hash_md5", "compressed_hash_sha2"))
+    _int_keys = frozenset(("size", "compressed_size", "modify_time"))
+
+    def __init__(self, asset_dict):
+        for key in self.__slots__:
+            setattr(self, key, None)
+
+        extra = {}
+        for key, value in asset_dict.items():
+            if key in self._hash_keys:
+                setattr(self, key, bytes.fromhex(value))
+            elif key in self._int_keys:
+                setattr(self, key, int(value))
+            elif key == "options":
+                self.options = tuple(sys.intern(str(i)) for i in value)
+            elif key in {"source", "compressed_source"}:
+                setattr(self, key, value)
+            elif key in {"dataset", "distribute"}:
+                setattr(self, key, sys.intern(value) if isinstance(value, str) else value)
+            else:
+                extra[sys.intern(key)] = sys.intern(value) if isinstance(value, str) else value
+        self.extra = extra if extra else None
+
+    def to_dict(self):
+        """Returns the asset dict in the format of the contents file."""
+        asset_dict = dict(self.extra) if self.extra is not None else {}
+        for key in self.__slots__:
+            value = getattr(self, key) if key != "extra" else None
+            if value is None:
+                continue
+            if key in self._hash_keys:
+                value = value.hex()
+            elif key == "options":
+                value = list(value)
+            asset_dict[key] = value
+        return dict(sorted(asset_dict.items()))
+
+
+class AssetRecord:
+    """Every package's copy of an asset, keyed by `asset_key()` in the database. After
+       `reduce_db()`, `asset` is the copy that will be output.
+    """
+
+    __slots__ = ("filename", "subpackages", "versions", "asset")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.subpackages = ()
+        self.versions = []
+        self.asset = None
+
+
+def asset_key(asset_category, asset_filename, arch=None):
+    """Returns the database key of an asset, (asset_category, asset_filename, arch). Each client
+       architecture has its own build of the artifacts, so copies of an artifact for different
+       architectures are different assets, even though they share a filename.
+    """
+    asset_category = sys.intern(asset_category.lower())
+    if asset_category != "artifacts" or arch is None:
+        arch = ""
+    return (asset_category, asset_filename.lower(), sys.intern(str(arch)))
+
+def load_asset_db(source_path, jobs=None, subpackage_options=None):
+    """Loads the asset database given by source path as a dict, mapping `asset_key()` to an
+       `AssetRecord` holding every package's copy of the asset. NOTE: this is a destructive
+       operation and will not return the data as-is on disk. If `subpackage_options` is given, it
+       is filled in with the options each subpackage lists for its assets, since `reduce_db()`
+       merges them, as {(subpackage_name, key): options}.
     """
     database = {}
-    yaml = YAML()
     logging.info(f"Loading asset database '{source_path}'...")
-    _load_package(source_path, "contents.yml", yaml, database)
-    # fixme: need to go through and validate hashes, zips???
+
+    # The index holds everything we need in a fraction of the time it takes to parse the YAML.
+    index_path = source_path.joinpath(_index.INDEX_FILENAME)
+    if index_path.exists():
+        with _index.AssetIndex(index_path) as index:
+            if index.is_current(source_path):
+                logging.info("Loading asset database index...")
+                for asset_category, asset_filename, subpackage_name, asset_dict in index:
+                    _add_asset(database, asset_category, asset_filename, AssetVersion(asset_dict), subpackage_name,
+                               subpackage_options)
+                return database
+            logging.info("Asset database index is out of date, ignoring it.")
+
+    # The results are folded into the database in the order they are listed, so the merged
+    # output does not depend on the scheduling.
+    bundles = load_bundles(source_path, jobs)
+    _load_package(source_path, "contents.yml", bundles, database, subpackage_options=subpackage_options)
     return database
 
-def _load_package(base_path, source_path, yaml, database, subpackage_name=None):
-    yaml_path = base_path.joinpath(source_path)
+def combine_db(database, other, relative_path):
+    """Folds the asset database `other` into `database`. `other` was loaded from `relative_path`
+       below the root of `database`, so its source paths are fixed up to match.
+    """
+    for key, other_record in other.items():
+        for version in other_record.versions:
+            version.source = _utils.win_path_str(relative_path, version.source)
+            if version.compressed_source is not None:
+                version.compressed_source = _utils.win_path_str(relative_path, version.compressed_source)
+        record = database.get(key)
+        if record is None:
+            database[key] = other_record
+        else:
+            record.subpackages += tuple(i for i in other_record.subpackages if i not in record.subpackages)
+            record.versions.extend(other_record.versions)
+
+def load_bundles(source_path, jobs=None):
+    """Parses the contents file of the asset database given by `source_path` and all of its
+       subpackages. Returns a dict mapping the path of each contents file, as listed by its parent,
+       to its parsed contents.
+    """
+    # Parsing the YAML is by far the slowest part, so all of the subpackages at each level of the
+    # bundle are parsed at once in a process pool.
+    bundles = {}
+    pool = multiprocessing.pool.Pool(jobs, initializer=_utils.multiprocess_init)
+    try:
+        pending = ["contents.yml"]
+        while pending:
+            # Sources are written with Windows separators, which aren't separators everywhere.
+            yaml_paths = [source_path.joinpath(*PureWindowsPath(i).parts) for i in pending]
+            bundles.update(zip(pending, pool.map(_load_yaml, yaml_paths)))
+            pending = [i["source"] for bundle in bundles.values() for i in bundle.get("subpackages", [])
+                       if i.get("source") and i["source"] not in bundles]
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+    return bundles
+
+def _load_yaml(yaml_path):
+    # The safe loader uses the C parser when it is available and skips all of the round-trip
+    # bookkeeping that we never use.
+    yaml = YAML(typ="safe")
+    return yaml.load(yaml_path)
+
+def _load_package(base_path, source_path, bundles, database, subpackage_name=None, subpackage_options=None):
+    yaml_path = base_path.joinpath(*PureWindowsPath(source_path).parts)
     logging.info(f"Loading package '{source_path}'...")
-    bundle = yaml.load(yaml_path)
+    bundle = dict(bundles[source_path])
     subpackages = bundle.pop("subpackages", [])
     if subpackages and bundle:
         logging.warning(f"Package '{source_path}' has subpackages and assets. This is nonstandard and may not work.")
@@ -58,25 +199,113 @@ def _load_package(base_path, source_path, yaml, database, subpackage_name=None):
         subpackage_path = i.get("source", None)
         if not subpackage_path:
             raise MalformedPackageError(source_path, f"has a subpackage named '{subpackage_name}' without a source path.")
-        _load_package(base_path, subpackage_path, yaml, database, subpackage_name)
+        _load_package(base_path, subpackage_path, bundles, database, subpackage_name, subpackage_options)
 
     # Map this out into an easy to consume way...
     relative_path = yaml_path.parent.relative_to(base_path)
+    _add_assets(database, bundle, source_path, relative_path, subpackage_name, subpackage_options)
+
+def _add_assets(database, bundle, source_path, relative_path, subpackage_name=None, subpackage_options=None):
     for asset_category, assets in bundle.items():
-        asset_category = asset_category.lower()
         for asset_filename, asset_dict in assets.items():
-            asset_map = database.setdefault((asset_category, asset_filename.lower()), { "filename": asset_filename })
-            if subpackage_name is not None:
-                asset_map.setdefault("subpackages", set()).add(subpackage_name)
-
             # Fixup the source paths to be relative from the database directory.
             if "source" not in asset_dict:
                 raise MalformedPackageError(source_path, f"has an asset ('{asset_category}', '{asset_filename}') without a source")
-            asset_dict["source"] = _utils.win_path_str(relative_path, asset_dict["source"])
-            if "compressed_source" in asset_dict:
-                asset_dict["compressed_source"] = _utils.win_path_str(relative_path, asset_dict["compressed_source"])
+            version = AssetVersion(asset_dict)
+            version.source = _utils.win_path_str(relative_path, version.source)
+            if version.compressed_source is not None:
+                version.compressed_source = _utils.win_path_str(relative_path, version.compressed_source)
+            _add_asset(database, asset_category, asset_filename, version, subpackage_name, subpackage_options)
 
-            asset_map.setdefault("dicts", []).append(asset_dict)
+def _add_asset(database, asset_category, asset_filename, version, subpackage_name=None, subpackage_options=None):
+    key = asset_key(asset_category, asset_filename, version.extra.get("arch") if version.extra else None)
+    if subpackage_options is not None:
+        subpackage_options[(subpackage_name, key)] = version.options
+    record = database.get(key)
+    if record is None:
+        record = database[key] = AssetRecord(asset_filename)
+    # Assets are rarely in more than a couple of subpackages, so a tuple is plenty.
+    if subpackage_name is not None and subpackage_name not in record.subpackages:
+        record.subpackages += (sys.intern(subpackage_name),)
+    record.versions.append(version)
+
+def verify_db(database, source_path, quick=False, cache=None, jobs=None):
+    """Checks every source file referenced by the database against the size and modify time
+       (if `quick`) or the size and digests recorded for it. Copies of assets that fail are
+       discarded. Returns False if anything failed verification.
+    """
+    # (key prefix, version) of everything recorded for each file. The files are usually unique,
+    # but each one is only checked once regardless.
+    sources = {}
+    for record in database.values():
+        for version in record.versions:
+            sources.setdefault(version.source, []).append(("", version))
+            if version.compressed_source is not None:
+                sources.setdefault(version.compressed_source, []).append(("compressed_", version))
+
+    logging.info(f"Verifying {len(sources)} source files...")
+    failed = set()
+    stats = {}
+    for source, uses in sources.items():
+        path = source_path.joinpath(*PureWindowsPath(source).parts)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            logging.error(f"Source file '{source}' is missing.")
+            failed.update(id(version) for _, version in uses)
+            continue
+
+        for prefix, version in uses:
+            size = getattr(version, f"{prefix}size")
+            if size is not None and size != stat.st_size:
+                logging.error(f"Source file '{source}' is {stat.st_size} bytes, expected {size}.")
+                failed.add(id(version))
+            elif quick and not prefix and version.modify_time is not None and version.modify_time != int(stat.st_mtime):
+                logging.error(f"Source file '{source}' has been modified since it was packaged.")
+                failed.add(id(version))
+        stats[source] = (path, stat)
+
+    if not quick:
+        # Files that haven't changed since they were last verified don't need to be read again.
+        hashes = {}
+        pending = []
+        for source, (path, stat) in stats.items():
+            hashes[source] = cache.lookup_hashes(path, stat) if cache is not None else None
+            if hashes[source] is None:
+                pending.append(source)
+
+        pool = multiprocessing.pool.Pool(jobs, initializer=_utils.multiprocess_init)
+        try:
+            results = pool.map(_utils.hash_file, (stats[i][0] for i in pending), chunksize=16)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        else:
+            pool.close()
+            pool.join()
+        for source, result in zip(pending, results):
+            hashes[source] = result
+            if cache is not None:
+                cache.store_hashes(*stats[source], result)
+
+        for source, result in hashes.items():
+            for prefix, version in sources[source]:
+                for key in ("hash_sha2", "hash_md5"):
+                    expected = getattr(version, f"{prefix}{key}")
+                    if expected is not None and expected.hex() != result[key]:
+                        logging.error(f"Source file '{source}' does not match its {key}.")
+                        failed.add(id(version))
+                        break
+
+    if failed:
+        for key in tuple(database.keys()):
+            record = database[key]
+            record.versions = [i for i in record.versions if id(i) not in failed]
+            if not record.versions:
+                del database[key]
+        logging.error(f"Discarded {len(failed)} assets that failed verification.")
+    return not failed
 
 def reduce_db(database):
     """Merges a flat asset database in the format used by `load_asset_db()`"""
@@ -85,14 +314,15 @@ def reduce_db(database):
             return element
 
         def _sanity_check(key):
-            if key not in value or key not in element:
+            value_key, element_key = getattr(value, key), getattr(element, key)
+            if value_key is None or element_key is None:
                 return False
-            if value[key] == element[key]:
+            if value_key == element_key:
                 return True
             raise PackageSanityError()
 
-        value_dataset = Dataset[value.get("dataset", "base").lower()]
-        element_dataset = Dataset[element.get("dataset", "base").lower()]
+        value_dataset = Dataset[(value.dataset or "base").lower()]
+        element_dataset = Dataset[(element.dataset or "base").lower()]
         if value_dataset == element_dataset:
             # Tries any of the listed keys to ensure the assets are equivalent. If none are available,
             # that is a failure to sanity check.
@@ -106,71 +336,143 @@ def reduce_db(database):
 
     nuke = []
     logging.info("Reducing database...")
-    for (asset_category, asset_filename), asset_map in database.items():
+    for key, record in database.items():
         try:
-            final_asset = functools.reduce(_find_priority_asset, asset_map["dicts"])
+            final_asset = functools.reduce(_find_priority_asset, record.versions)
         except PackageSanityError:
-            logging.error(f"Asset ('{asset_category}', '{asset_filename}') has conflicts. Discarding.")
-            nuke.append((asset_category, asset_filename))
+            logging.error(f"Asset {key} has conflicts. Discarding.")
+            nuke.append(key)
         else:
             # Even though we have the "final" version, we need to merge in the options to ensure
             # nothing gets lost from the other copies of this asset.
-            _utils.merge_options(final_asset, asset_map["dicts"])
-            asset_map["asset"] = final_asset
+            options = set(itertools.chain.from_iterable(i.options for i in record.versions if i.options))
+            if options:
+                final_asset.options = tuple(sorted(options))
+            record.asset = final_asset
     for i in nuke:
         del database[i]
 
-def save_db(database, source_path, dest_path, preserve_subpackages=False):
-    def copy_asset(key):
-        asset_source_path = source_path.joinpath(asset_map["asset"][key])
-        asset_dest_path = dest_path.joinpath(asset_subdirectories[asset_category], asset_map["filename"])
-        logging.debug(f"Copying '{asset_source_path}' to '{asset_dest_path}'")
-        outfile.copy_file(asset_source_path, asset_dest_path)
-        asset_map["asset"][key] = _utils.win_path_str(asset_subdirectories[asset_category], asset_map["filename"])
-
-    with _utils.OutputManager(dest_path) as outfile:
-        all_outputs = {}
-        logging.info("Copying assets...")
-        for (asset_category, asset_filename), asset_map in database.items():
-            if "asset" not in asset_map:
-                logging.error(f"Asset ('{asset_category}', '{asset_filename}') needs to be reduced!")
-                continue
+def save_db(database, source_path, dest_path, preserve_subpackages=False, link_mode=LinkMode.copy):
+    with _utils.OutputManager(dest_path, link_mode=link_mode) as outfile:
+        write_db(database, source_path, outfile, preserve_subpackages)
 
-            copy_asset("source")
-            if "compressed_source" in asset_map["asset"]:
-                copy_asset("compressed_source")
+def write_db(database, source_path, outfile, preserve_subpackages=False, subpackage_options=None):
+    """Copies the reduced assets in `database` from `source_path` and writes their contents files
+       to the `OutputManager` `outfile`. If the database has artifacts for several architectures,
+       each architecture's artifacts are written to their own "Client-<arch>" subpackage, since
+       their filenames collide. Everything else then goes in a "Shared" subpackage, unless the
+       subpackages are preserved anyway. Preserved subpackages list the options given for them
+       by `subpackage_options`, as filled in by `load_asset_db()`, instead of the merged ones.
+    """
+    def copy_asset(key, filename, size, hash_sha2):
+        asset_source_path = source_path.joinpath(*PureWindowsPath(getattr(record.asset, key)).parts)
+        asset_dest_path = dest_dir.joinpath(filename)
+        # Merging onto a previous merge leaves most of the files as they are.
+        if outfile.is_identical(asset_source_path, asset_dest_path, size, hash_sha2.hex() if hash_sha2 else None):
+            logging.debug(f"'{asset_dest_path}' is already up to date")
+        else:
+            logging.debug(f"Copying '{asset_source_path}' to '{asset_dest_path}'")
+            outfile.copy_file(asset_source_path, asset_dest_path)
+        setattr(record.asset, key, _utils.win_path_str(asset_dest_path))
 
-            if preserve_subpackages:
-                subpackages = (all_outputs.setdefault(i, {}) for i in asset["subpackages"])
-            else:
-                subpackages = [all_outputs,]
-            for subpackage in subpackages:
-                output_category = subpackage.setdefault(asset_category, {})
-                output_category[asset_map["filename"]] = asset_map["asset"]
-
-        yaml = YAML()
-        if preserve_subpackages:
-            subpackages = [{ "name": subpackage_name, "source": f"{subpackage_name}.yml" }
-                           for subpackage_name in all_outputs.keys()]
-            logging.info("Writing subpackage YAML...")
-            for subpackage in subpackages:
-                yaml.dump(all_outputs[subpackage["name"]], outfile.open_file(subpackage["source"], "w"))
-                all_outputs.pop(subpackage["name"])
-            all_outputs["subpackages"] = subpackages
-        logging.info("Writing package YAML...")
-        yaml.dump(all_outputs, outfile.open("contents.yml", "w"))
+    archs = { arch for _, _, arch in database.keys() if arch }
+    split_archs = len(archs) > 1
+    if split_archs and not preserve_subpackages:
+        preserve_subpackages = True
+        shared_subpackages = ("Shared",)
+    else:
+        shared_subpackages = None
+
+    all_outputs = {}
+    logging.info("Copying assets...")
+    # The output is sorted so that it doesn't depend on the order the packages were loaded in,
+    # which lets the shards of a package merge into exactly what the whole package would.
+    for (asset_category, asset_filename, arch), record in sorted(database.items(), key=lambda x: x[0]):
+        if record.asset is None:
+            logging.error(f"Asset ('{asset_category}', '{asset_filename}') needs to be reduced!")
+            continue
+
+        dest_dir = Path(asset_subdirectories[asset_category])
+        if split_archs and arch:
+            dest_dir = dest_dir.joinpath(arch)
+            record_subpackages = (f"Client-{arch}",)
+        else:
+            record_subpackages = shared_subpackages or record.subpackages
+
+        asset = record.asset
+        copy_asset("source", record.filename, asset.size, asset.hash_sha2)
+        if asset.compressed_source is not None:
+            compressed_filename = f"{record.filename}{PureWindowsPath(asset.compressed_source).suffix}"
+            copy_asset("compressed_source", compressed_filename, asset.compressed_size, asset.compressed_hash_sha2)
+
+        for subpackage_name in record_subpackages if preserve_subpackages else (None,):
+            output = all_outputs.setdefault(subpackage_name, {}) if preserve_subpackages else all_outputs
+            output_dict = output.setdefault(asset_category, {})[record.filename] = record.asset.to_dict()
+            options_key = (subpackage_name, (asset_category, asset_filename, arch))
+            if subpackage_options is not None and options_key in subpackage_options:
+                # The merged options always include the subpackage's own, so they keep their place.
+                if subpackage_options[options_key]:
+                    output_dict["options"] = list(subpackage_options[options_key])
+                else:
+                    output_dict.pop("options", None)
+
+    yaml = YAML()
+    index_packages = []
+    if preserve_subpackages:
+        subpackages = [{ "name": subpackage_name, "source": f"{subpackage_name}.yml" }
+                       for subpackage_name in sorted(all_outputs.keys())]
+        logging.info("Writing subpackage YAML...")
+        for subpackage in subpackages:
+            package_dict = all_outputs.pop(subpackage["name"])
+            with outfile.open(subpackage["source"], "w") as stream:
+                yaml.dump(package_dict, stream)
+            index_packages.append((subpackage["name"], subpackage["source"], package_dict))
+        all_outputs["subpackages"] = subpackages
+        index_packages.insert(0, (None, "contents.yml", {}))
+    else:
+        index_packages.append((None, "contents.yml", all_outputs))
+    logging.info("Writing package YAML...")
+    with outfile.open("contents.yml", "w") as stream:
+        yaml.dump(all_outputs, stream)
+    _index.write_index(outfile, index_packages)
 
 def main(args):
-    source_path = args.source
-    if not source_path.exists():
-        logging.error(f"Source path '{source_path}' does not exist.")
-        return False
-    if not source_path.is_dir():
-        logging.error(f"Source path '{source_path}' must be a directory.")
-        return False
-
-    database = load_asset_db(source_path)
-    reduce_db(database)
-    save_db(database, source_path, args.destination)
-
-    return True
+    for source_path in args.sources:
+        if not source_path.exists():
+            logging.error(f"Source path '{source_path}' does not exist.")
+            return False
+        if not source_path.is_dir():
+            logging.error(f"Source path '{source_path}' must be a directory.")
+            return False
+
+    # Everything is copied relative to the directory holding all of the sources.
+    if len(args.sources) == 1:
+        source_path = args.sources[0]
+    else:
+        try:
+            source_path = Path(os.path.commonpath([i.resolve() for i in args.sources]))
+        except ValueError:
+            logging.error("Source paths must be on the same drive.")
+            return False
+
+    with _profile.open_profiler(args) as profiler:
+        with _profile.stage(profiler, "load"):
+            if len(args.sources) == 1:
+                database = load_asset_db(source_path, args.jobs)
+            else:
+                database = {}
+                for i in args.sources:
+                    combine_db(database, load_asset_db(i, args.jobs), i.resolve().relative_to(source_path))
+        result = True
+        with _profile.stage(profiler, "verify"):
+            if args.verify == "full":
+                with _cache.open_cache(args) as cache:
+                    result = verify_db(database, source_path, cache=cache, jobs=args.jobs)
+            elif args.verify == "quick":
+                result = verify_db(database, source_path, quick=True)
+        with _profile.stage(profiler, "reduce"):
+            reduce_db(database)
+        with _profile.stage(profiler, "save"):
+            save_db(database, source_path, args.destination, link_mode=args.link_mode)
+
+    return result
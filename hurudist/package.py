@@ -17,41 +17,38 @@ from PyHSPlasma import *
 from ruamel.yaml import YAML
 
 from _constants import *
+import contextlib
 import functools
 import io
 import itertools
 import logging
-import multiprocessing, multiprocessing.pool
+import os
 import pathlib
-import subprocess
+import queue
+import tempfile
+import threading
+import time
+import _cache
+import _index
+import _pipeline
+import _profile
 import _utils
 
-def coerce_asset_dicts(all_outputs, all_pages, all_page_dicts):
-    """Forcibly merges asset dicts, preserving only options keys"""
-    for (age_name, page_path), age_page_dict in zip(all_pages, all_page_dicts):
-        output = all_outputs[age_name]
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    # Without watchdog, the client is polled for changes instead.
+    Observer = None
 
-        for asset_category, assets in age_page_dict.items():
-            if not asset_category in output:
-                output[asset_category] = assets
-            else:
-                output_category = output[asset_category]
-                for asset_name, asset_dict in assets.items():
-                    output_dict = output_category.setdefault(asset_name, asset_dict)
-                    if "options" in output_dict:
-                        new_options = set(output_dict["options"])
-                        new_options.update(asset_dict.get("options", []))
-                        output_dict["options"] = list(new_options)
-
-def find_all_pages(all_outputs, data_path, *age_infos):
-    # Collect a list of all age pages to be abused for the purpose of finding its resources
+def _generate_page_paths(age_info, data_path):
     # Would be nice if this were a common function of libHSPlasma...
-    def _generate_page_paths(age_info):
-        for i in range(age_info.getNumPages()):
-            yield data_path.joinpath(age_info.getPageFilename(i, pvMoul))
-        for i in range(age_info.getNumCommonPages(pvMoul)):
-            yield data_path.joinpath(age_info.getCommonPageFilename(i, pvMoul))
+    for i in range(age_info.getNumPages()):
+        yield data_path.joinpath(age_info.getPageFilename(i, pvMoul))
+    for i in range(age_info.getNumCommonPages(pvMoul)):
+        yield data_path.joinpath(age_info.getCommonPageFilename(i, pvMoul))
 
+def find_all_pages(all_outputs, data_path, *age_infos, stat=_utils.stat_file):
+    # Collect a list of all age pages to be abused for the purpose of finding its resources
     for age_info in age_infos:
         output = all_outputs.setdefault(age_info.name, {})
         data = output.setdefault("data", {})
@@ -60,23 +57,43 @@ def find_all_pages(all_outputs, data_path, *age_infos):
         if age_info.seqPrefix > 0:
             data[f"{age_info.name}.fni"] = {}
 
-        for page_path in _generate_page_paths(age_info):
-            if page_path.exists():
+        for page_path in _generate_page_paths(age_info, data_path):
+            if stat(page_path) is not None:
                 data[str(page_path.relative_to(data_path))] = {}
                 yield (age_info.name, page_path)
             else:
                 logging.warning(f"Age Page '{page_path.name}' is missing from the client...")
 
-def find_client_dependencies(all_outputs, client_path, scripts_path, client_arch):
-    output = all_outputs.setdefault("Client", {})
+def partition_ages(age_infos, data_path, shard_count, stat=_utils.stat_file):
+    """Splits the ages into `shard_count` lists with about the same total page size. The split
+       only depends on the names and page sizes of the ages, so every shard of a build agrees on
+       it as long as they all package the same client.
+    """
+    def _age_size(age_info):
+        stats = (stat(i) for i in _generate_page_paths(age_info, data_path))
+        return sum(i.st_size for i in stats if i is not None)
+
+    # Biggest first, each onto the least loaded shard. Ties go to the lowest name and shard.
+    ages = sorted(((_age_size(i), i.name.lower(), i) for i in age_infos), key=lambda x: (-x[0], x[1]))
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for size, _, age_info in ages:
+        shard = min(range(shard_count), key=lambda x: (loads[x], x))
+        shards[shard].append(age_info)
+        loads[shard] += size
+    return shards
+
+def find_client_artifacts(output, client_path, client_arch, list_files=_utils.list_files):
+    """Adds the exes, DLLs, and installers of the client at `client_path` to the package `output`."""
     asset_category = output.setdefault("artifacts", {})
 
     def handle_client_file(path, exe_defn={}):
         extension = path.suffix.lower()
-        if extension == ".lnk" or not path.is_file():
+        if extension == ".lnk":
             return
 
-        asset = asset_category.setdefault(str(path.relative_to(client_path)), exe_defn)
+        # The definitions are shared by every client we package, so don't scribble on them.
+        asset = asset_category.setdefault(str(path.relative_to(client_path)), dict(exe_defn))
         if extension in {".cab", ".dll", ".exe", ".msi"}:
             # Not a client, so maybe an installer...
             if not exe_defn and extension in {".exe", ".msi"}:
@@ -94,43 +111,79 @@ def find_client_dependencies(all_outputs, client_path, scripts_path, client_arch
         asset["arch"] = str(client_arch)
 
     # Anything in the client root (except shortcuts) must be included.
-    for i in client_path.iterdir():
+    for i in list_files(client_path):
         handle_client_file(i, client_executables.get(i.stem.lower(), {}))
 
     # MOULa standard uses the "extras" directory for redists...?
-    for i in client_path.joinpath("extras").iterdir():
+    for i in list_files(client_path.joinpath("extras")):
         handle_client_file(i)
 
+def find_client_dependencies(all_outputs, clients, scripts_path, sdl_index, list_files=_utils.list_files):
+    """Adds the client to the packages. `clients` is a sequence of (client_path, client_arch) for
+       each architecture being packaged, the first of which provides everything that is shared
+       between architectures. If there are several, the artifacts of each architecture are put in
+       their own "Client-<arch>" package. Returns a dict mapping the names of those packages to
+       their client paths.
+    """
+    client_path, client_arch = clients[0]
+    output = all_outputs.setdefault("Client", {})
+    client_paths = {}
+    if len(clients) == 1:
+        find_client_artifacts(output, client_path, client_arch, list_files)
+    else:
+        for arch_client_path, arch in clients:
+            package_name = f"Client-{arch}"
+            find_client_artifacts(all_outputs.setdefault(package_name, {}), arch_client_path, arch, list_files)
+            client_paths[package_name] = arch_client_path
+
     # Required SDLs for plSynchedObject
     asset_category = output.setdefault("sdl", {})
-    sdl_path = make_asset_path("sdl", client_path=client_path, scripts_path=scripts_path)
-    sdl_mgrs = load_sdl_descriptors(sdl_path)
-    for sdl_paths, _ in map(functools.partial(find_sdl_depdendencies, sdl_mgrs), client_sdl):
+    for sdl_paths in map(sdl_index.find_dependencies, client_sdl):
         for i in sdl_paths:
             asset_category.setdefault(i.name, {})
 
     # Engine python code
     asset_category = output.setdefault("python", {})
     py_path = make_asset_path("python", client_path=client_path, scripts_path=scripts_path)
-    for i in itertools.chain(py_path.joinpath("plasma").glob("*.py"), py_path.joinpath("system").glob("*.py")):
-        asset_category.setdefault(str(i.relative_to(py_path)), {})
+    for i in itertools.chain(list_files(py_path.joinpath("plasma")), list_files(py_path.joinpath("system"))):
+        if i.match("*.py"):
+            asset_category.setdefault(str(i.relative_to(py_path)), {})
 
     # Core videos
     asset_category = output.setdefault("avi", {})
     avi_path = make_asset_path("avi", client_path=client_path)
-    for i in itertools.chain(avi_path.glob("*.avi"), avi_path.glob("*.bik"), avi_path.glob("*.webm")):
+    for i in list_files(avi_path):
+        if not any(map(i.match, ("*.avi", "*.bik", "*.webm"))):
+            continue
         stem = i.stem.lower()
         if stem.startswith("intro") or stem in {"cyanworlds", "uruliveintro"}:
             asset_category.setdefault(str(i.relative_to(avi_path)), {})
 
-def find_page_externals(path, dlevel=plDebug.kDLNone):
-    # Optimization: Textures.prp does not have any externals...
-    if path.name.endswith("Textures.prp"):
-        return {}
-
+    return client_paths
+
+# Bump this whenever the output of `find_page_externals()` changes to invalidate cached page scans.
+PAGE_SCAN_VERSION = 2
+
+def _read_page_objects(mgr, path, keys):
+    """Reads only the objects of `keys` from a page that was loaded as stubs."""
+    objects = []
+    if keys:
+        stream = hsFileStream(mgr.getVer()).open(path, fmRead)
+        try:
+            for key in keys:
+                stream.seek(key.fileOff)
+                objects.append(mgr.ReadCreatable(stream))
+        finally:
+            stream.close()
+    return objects
+
+def find_page_externals(path, dlevel=plDebug.kDLNone, keys_only=True):
+    """Finds the Python modules, sounds, and CSV needed by a page. In `keys_only` mode, the page is
+       read as stubs, and only the objects whose fields we need are ever deserialized.
+    """
     plDebug.Init(dlevel)
     mgr = plResManager()
-    page_info = mgr.ReadPage(path)
+    page_info = mgr.ReadPage(path, keys_only)
     location = page_info.location
 
     def sfx_flags_as_str(flags):
@@ -142,15 +195,16 @@ def find_page_externals(path, dlevel=plDebug.kDLNone):
             else:
                 yield "sound_cache_stereo"
 
-    sfx_idx = plFactory.ClassIndex("plSoundBuffer")
-    pfm_idx = plFactory.ClassIndex("plPythonFileMod")
+    def get_objects(class_name):
+        keys = mgr.getKeys(location, plFactory.ClassIndex(class_name))
+        return _read_page_objects(mgr, path, keys) if keys_only else [i.object for i in keys]
 
     result = {
-        "python": { f"{i.object.filename}.py": { "options": ["pfm"] }
-                    for i in mgr.getKeys(location, pfm_idx) },
+        "python": { f"{i.filename}.py": { "options": ["pfm"] }
+                    for i in get_objects("plPythonFileMod") },
 
-        "sfx": { i.object.fileName: { "options": list(sfx_flags_as_str(i.object.flags)) }
-                 for i in mgr.getKeys(location, sfx_idx) },
+        "sfx": { i.fileName: { "options": list(sfx_flags_as_str(i.flags)) }
+                 for i in get_objects("plSoundBuffer") },
     }
 
     # I know this isn't pretty, deal with it.
@@ -159,102 +213,37 @@ def find_page_externals(path, dlevel=plDebug.kDLNone):
 
     return result
 
-def find_pfm_externals(all_outputs, py_exe, no_py_mods, no_sdl_mods, py_path, sdl_path):
-    def pool_cb(output, asset_category, source_path, asset_paths):
-        for asset_path in asset_paths:
-            asset_key = str(asset_path.relative_to(source_path))
-            output.setdefault(asset_category, {}).setdefault(asset_key, {})
+def _timed_find_page_externals(path, dlevel):
+    start = time.perf_counter()
+    result = find_page_externals(path, dlevel)
+    return result, time.perf_counter() - start
 
-    pool = multiprocessing.pool.Pool(initializer=_utils.multiprocess_init)
-    try:
-        for output in all_outputs.values():
-            pfm_names = [pathlib.Path(i).stem for i in output.get("python", {}).keys()]
-            py_cb = functools.partial(pool_cb, output, "python", py_path)
-            sdl_cb = functools.partial(pool_cb, output, "sdl", sdl_path)
-
-            if not no_sdl_mods:
-                pool.apply_async(find_pfm_sdlmods, (sdl_path, pfm_names),
-                                 callback=sdl_cb, error_callback=log_exception)
-            if not no_py_mods:
-                pool.apply_async(find_pfm_dependency_pymodules, (py_exe, py_path, pfm_names),
-                                 callback=py_cb, error_callback=log_exception)
-    except:
-        pool.terminate()
-        pool.join()
-        raise
-    else:
-        # Ensure all jobs finish
-        pool.close()
-        pool.join()
-
-def find_pfm_sdlmods(source_path, pfm_names):
-    sdl_mgrs = load_sdl_descriptors(source_path)
+def find_pfm_sdlmods(sdl_index, pfm_names):
     sdl_file_names = set()
     for py_module_name in pfm_names:
-        more_sdl_files, _ = find_sdl_depdendencies(sdl_mgrs, py_module_name)
-        sdl_file_names.update(more_sdl_files)
+        sdl_file_names.update(sdl_index.find_dependencies(py_module_name))
     return tuple(sdl_file_names)
 
-def find_pfm_dependency_pymodules(py_exe, source_path, pfm_names):
-    module_names = set()
-    for py_module_name in pfm_names:
-        module_names.update(find_python_dependencies(py_exe, py_module_name, source_path))
-    return tuple(module_names)
-
-def find_python_dependencies(py_exe, module_name, scripts_path):
+def find_python_dependencies(py_server, module_name, scripts_path):
     plasma_python_path = scripts_path.joinpath("plasma")
-    args = (str(py_exe), str(_utils.find_python2_tools()), "get_imports", str(module_name),
-            str(scripts_path), str(plasma_python_path))
-    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8")
-    if result.returncode == PyToolsResultCodes.success:
-        with io.StringIO(result.stdout) as strio:
-            for py_abs_path in strio:
-                module_path = pathlib.Path(py_abs_path.rstrip())
-
-                # Don't include any of the builtin engine-level code in python/plasma
-                try:
-                    module_path.relative_to(plasma_python_path)
-                except ValueError:
-                    yield module_path
+    returncode, module_paths, output = py_server.get_imports(module_name)
+    if returncode == PyToolsResultCodes.success:
+        for py_abs_path in module_paths:
+            module_path = pathlib.Path(py_abs_path)
+
+            # Don't include any of the builtin engine-level code in python/plasma or anything
+            # from the interpreter's standard library.
+            if scripts_path in module_path.parents and plasma_python_path not in module_path.parents:
+                yield module_path
     else:
-        if result.returncode == PyToolsResultCodes.traceback:
-            logging.error(f"Python module {module_name} failed to import\n{result.stdout}.")
-        elif result.returncode == PyToolsResultCodes.file_not_found:
+        if returncode == PyToolsResultCodes.traceback:
+            logging.error(f"Python module {module_name} failed to import\n{output}.")
+        elif returncode == PyToolsResultCodes.file_not_found:
             logging.warning(f"Python module {module_name} could not be found.")
         else:
-            logging.warning(f"Unhandled error {result.returncode} when importing Python module {module_name}.\n{result.stdout}")
-
-def find_sdl_depdendencies(sdl_mgrs, descriptor_name, embedded_sdr=False):
-    dependencies = set()
-    descriptors = set()
-
-    for sdl_file, mgr in sdl_mgrs.items():
-        descriptor = mgr.getDescriptor(descriptor_name)
-        if descriptor is not None:
-            break
-    else:
-        if embedded_sdr:
-            logging.error(f"Embedded SDL Descriptor '{descriptor_name}' is missing from the client.")
-        else:
-            logging.debug(f"Top-level SDL '{descriptor_name}' is missing from the client.")
-        return dependencies, descriptors
-
-    dependencies.add(sdl_file)
-    descriptors.add(descriptor.name)
-
-    # We need to see if there are any embedded state descriptor variables...
-    for variable in descriptor.variables:
-        if variable.type == plVarDescriptor.kStateDescriptor and not variable.stateDescType in descriptors:
-            more_dependencies, more_descriptors = find_sdl_depdendencies(sdl_mgrs, variable.stateDescType, True)
-            dependencies.update(more_dependencies)
-            descriptors.update(more_descriptors)
-    return dependencies, descriptors
+            logging.warning(f"Unhandled error {returncode} when importing Python module {module_name}.\n{output}")
 
 def load_age(age_path):
-    if not age_path.exists():
-        logging.critical(f"Age file '{age_path}' does not exist.")
-        return None
-
     age_info = plAgeInfo()
     try:
         age_info.readFromFile(age_path)
@@ -269,7 +258,7 @@ def load_sdl_descriptors(sdl_path):
         # Strictly speaking, due to the configurable nature of the key, btea/notthedroids encrypted
         # SDL files are not allowed here. So, let's detect that.
         if plEncryptedStream.IsFileEncrypted(sdl_file):
-            logging.error("SDL File '{sdl_file.name}' is encrypted and cannot be used for packaging.")
+            logging.error(f"SDL File '{sdl_file.name}' is encrypted and cannot be used for packaging.")
             continue
 
         mgr = plSDLMgr()
@@ -277,8 +266,325 @@ def load_sdl_descriptors(sdl_path):
         sdl_mgrs[sdl_file] = mgr
     return sdl_mgrs
 
-def log_exception(ex):
-    logging.exception(ex)
+class SDLIndex:
+    """Index of the SDL descriptors in a directory that is shared by everything in a run. The
+       descriptor files are only parsed on first use, and the files needed by each descriptor
+       (including its embedded STATEDESCs) are memoized.
+    """
+
+    def __init__(self, sdl_path):
+        self.path = sdl_path
+        self._sdl_mgrs = None
+        self._descriptors = {}
+        self._dependencies = {}
+
+    def find_descriptor(self, descriptor_name, embedded_sdr=False):
+        """Returns the SDL file and descriptor for `descriptor_name` or (None, None)."""
+        if descriptor_name in self._descriptors:
+            return self._descriptors[descriptor_name]
+
+        if self._sdl_mgrs is None:
+            self._sdl_mgrs = load_sdl_descriptors(self.path)
+        for sdl_file, mgr in self._sdl_mgrs.items():
+            descriptor = mgr.getDescriptor(descriptor_name)
+            if descriptor is not None:
+                break
+        else:
+            if embedded_sdr:
+                logging.error(f"Embedded SDL Descriptor '{descriptor_name}' is missing from the client.")
+            else:
+                logging.debug(f"Top-level SDL '{descriptor_name}' is missing from the client.")
+            sdl_file, descriptor = None, None
+
+        self._descriptors[descriptor_name] = (sdl_file, descriptor)
+        return sdl_file, descriptor
+
+    def find_dependencies(self, descriptor_name):
+        """Returns a frozenset of all SDL files needed to use the descriptor `descriptor_name`."""
+        if descriptor_name in self._dependencies:
+            return self._dependencies[descriptor_name]
+
+        dependencies = set()
+        visited = set()
+        stack = [(descriptor_name, False)]
+        while stack:
+            name, embedded_sdr = stack.pop()
+            if name in visited:
+                continue
+            visited.add(name)
+            if name in self._dependencies:
+                dependencies.update(self._dependencies[name])
+                continue
+
+            sdl_file, descriptor = self.find_descriptor(name, embedded_sdr)
+            if descriptor is None:
+                continue
+            dependencies.add(sdl_file)
+
+            # We need to see if there are any embedded state descriptor variables...
+            for variable in descriptor.variables:
+                if variable.type == plVarDescriptor.kStateDescriptor:
+                    stack.append((variable.stateDescType, True))
+
+        result = frozenset(dependencies)
+        self._dependencies[descriptor_name] = result
+        return result
+
+
+class DependencyResolver:
+    """Merges the assets found by page scans into the packages as each scan completes. Every new
+       asset is handed to the pipeline for stat and hashing right away, and each new
+       PythonFileMod is resolved by a persistent Python interpreter while other pages are still
+       being scanned.
+    """
+
+    def __init__(self, pipeline, client_path, scripts_path, dlevel=plDebug.kDLNone, py_exe=None):
+        self._pipeline = pipeline
+        self._client_path = client_path
+        self._scripts_path = scripts_path
+        self._py_path = make_asset_path("python", client_path=client_path, scripts_path=scripts_path)
+        self._dlevel = dlevel
+        self._py_exe = py_exe
+        self._py_servers = queue.SimpleQueue()
+        self._py_dependencies = {}
+        self._lock = threading.RLock()
+        self.page_hits = 0
+        self.page_misses = 0
+        self._page_times = []
+        self._pages = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        while not self._py_servers.empty():
+            self._py_servers.get().close()
+        return False
+
+    def add_asset(self, output, asset_category, asset_filename, asset_dict):
+        """Adds an asset to the package `output`, merging the options of any existing entry."""
+        with self._lock:
+            assets = output.setdefault(asset_category, {})
+            output_dict = assets.get(asset_filename)
+            if output_dict is None:
+                assets[asset_filename] = asset_dict
+                self._pipeline.add_asset(make_asset_path(asset_category, asset_filename,
+                                                         client_path=self._client_path,
+                                                         scripts_path=self._scripts_path))
+            elif "options" in asset_dict:
+                new_options = set(output_dict.get("options", []))
+                new_options.update(asset_dict["options"])
+                output_dict["options"] = list(new_options)
+
+            if self._py_exe is not None and "pfm" in asset_dict.get("options", []):
+                self._add_python_module(output, pathlib.Path(asset_filename).stem)
+
+    def add_package_assets(self, all_outputs, client_paths={}):
+        """Starts collecting the stat and digests of every asset currently in the packages, which
+           may already be getting filled in by page scans.
+        """
+        with self._lock:
+            add_package_assets(self._pipeline, all_outputs, self._client_path, self._scripts_path, client_paths)
+
+    def forget(self, paths):
+        """Discards the page scans and Python dependencies that may be out of date now that the
+           files given by `paths` have changed.
+        """
+        with self._lock:
+            for i in paths:
+                self._pages.pop(i, None)
+            if any(i.suffix.lower() == ".py" for i in paths):
+                # Any module may now import something else, and the interpreters may still hold
+                # the old code.
+                self._py_dependencies.clear()
+                while not self._py_servers.empty():
+                    self._py_servers.get().close()
+
+    def _add_python_module(self, output, module_name):
+        dependencies = self._py_dependencies.get(module_name)
+        if dependencies is None:
+            # Many ages share the same modules, so each unique module is only resolved once.
+            self._py_dependencies[module_name] = [output]
+            self._pipeline.submit(self._pipeline.io_pool, "pfm", self._resolve_python_module,
+                                  (module_name,), functools.partial(self._on_python_module, module_name),
+                                  functools.partial(self._on_python_module_failed, module_name))
+        elif isinstance(dependencies, list):
+            dependencies.append(output)
+        else:
+            self._add_python_dependencies(output, dependencies)
+
+    def _resolve_python_module(self, module_name):
+        try:
+            py_server = self._py_servers.get_nowait()
+        except queue.Empty:
+            py_server = _utils.PyToolsServer(self._py_exe, self._py_path, self._py_path.joinpath("plasma"))
+        try:
+            dependencies = tuple(find_python_dependencies(py_server, module_name, self._py_path))
+        except:
+            py_server.close(kill=True)
+            raise
+        # Only servers that finished their last request are handed out again.
+        self._py_servers.put(py_server)
+        return dependencies
+
+    def _on_python_module(self, module_name, dependencies):
+        with self._lock:
+            outputs = self._py_dependencies[module_name]
+            self._py_dependencies[module_name] = dependencies
+            for output in outputs:
+                self._add_python_dependencies(output, dependencies)
+
+    def _on_python_module_failed(self, module_name, ex):
+        logging.error(f"Failed to resolve the imports of Python module {module_name}: {ex}")
+        self._on_python_module(module_name, ())
+
+    def _add_python_dependencies(self, output, dependencies):
+        for i in dependencies:
+            self.add_asset(output, "python", str(i.relative_to(self._py_path)), {})
+
+    def scan_page(self, output, page_path):
+        """Starts finding the externals of a page, skipping PyHSPlasma if the results are already
+           known from an earlier scan or to the cache. The work remains in the "scan" group until
+           the results are merged.
+        """
+        self._pipeline.acquire("scan")
+        with self._lock:
+            result = self._pages.get(page_path)
+        if result is not None:
+            self._on_page_scanned(output, page_path, result, hit=True)
+        elif self._pipeline.cache is None:
+            self._scan_page(page_path, functools.partial(self._on_page_result, output, page_path))
+        else:
+            self._pipeline.add_asset(page_path)
+            self._pipeline.on_stat(page_path, functools.partial(self._on_page_stat, output, page_path))
+
+    def _on_page_stat(self, output, page_path, stat):
+        cache = self._pipeline.cache
+        result = cache.lookup_page(page_path, stat, PAGE_SCAN_VERSION) if stat is not None else None
+        if result is not None:
+            self._on_page_scanned(output, page_path, result, hit=True)
+            return
+
+        # Pages that were touched without changing (eg by a fresh checkout) can still be matched
+        # by their contents. Hashing is much cheaper than reading the whole page, and the page
+        # hashes are queued ahead of everything else, so the page is only scanned if that fails.
+        self._pipeline.on_hashed(page_path, functools.partial(self._on_page_hashed, output, page_path, stat))
+
+    def _on_page_hashed(self, output, page_path, stat, hashes):
+        cache = self._pipeline.cache
+        result = cache.lookup_page_hash(hashes["hash_sha2"], PAGE_SCAN_VERSION) if hashes is not None else None
+        if result is not None:
+            cache.store_page(page_path, stat, hashes["hash_sha2"], PAGE_SCAN_VERSION, result)
+            self._on_page_scanned(output, page_path, result, hit=True)
+            return
+
+        def _on_scanned(result):
+            try:
+                if result is not None and hashes is not None:
+                    cache.store_page(page_path, stat, hashes["hash_sha2"], PAGE_SCAN_VERSION, result)
+            finally:
+                self._on_page_result(output, page_path, result)
+
+        self._scan_page(page_path, _on_scanned)
+
+    def _scan_page(self, page_path, callback):
+        """Scans the page in the process pool, then passes the results to `callback`, or None if
+           the scan failed.
+        """
+        def _timed_callback(result):
+            result, elapsed = result
+            with self._lock:
+                self._page_times.append((elapsed, page_path))
+            callback(result)
+
+        def _error_callback(ex):
+            logging.exception(ex)
+            callback(None)
+
+        self._pipeline.submit(self._pipeline.pool, "scan", _timed_find_page_externals, (page_path, self._dlevel),
+                              _timed_callback, _error_callback)
+
+    def _on_page_result(self, output, page_path, result, hit=False):
+        if result is None:
+            self._pipeline.release("scan")
+        else:
+            self._on_page_scanned(output, page_path, result, hit)
+
+    def log_page_times(self, jobs):
+        """Logs the slowest pages scanned since the last call. Nothing finishes scanning sooner than
+           the slowest page or an even share of the total work, whichever is longer.
+        """
+        with self._lock:
+            page_times = sorted(self._page_times, key=lambda x: x[0], reverse=True)
+            self._page_times = []
+        if not page_times:
+            return
+        total = sum(elapsed for elapsed, _ in page_times)
+        logging.info(f"Scanned {len(page_times)} pages in {total:.2f}s of work, at best {max(page_times[0][0], total / jobs):.2f}s "
+                     f"with {jobs} workers. Slowest pages:")
+        for elapsed, page_path in page_times[:5]:
+            logging.info(f"    {page_path.name} ({elapsed:.2f}s)")
+
+    def _on_page_scanned(self, output, page_path, result, hit=False):
+        try:
+            with self._lock:
+                self._pages[page_path] = result
+                if hit:
+                    self.page_hits += 1
+                else:
+                    self.page_misses += 1
+                for asset_category, assets in result.items():
+                    for asset_filename, asset_dict in assets.items():
+                        self.add_asset(output, asset_category, asset_filename, asset_dict)
+        finally:
+            self._pipeline.release("scan")
+
+
+class AssetCompressor:
+    """Creates the gzipped copies of assets in the pipeline's process pool. Each source file is
+       only compressed once, no matter how many packages it belongs to.
+    """
+
+    def __init__(self, pipeline, temp_path, min_savings):
+        self._pipeline = pipeline
+        self._temp_path = temp_path
+        self._min_savings = min_savings
+        self._lock = threading.Lock()
+        self._results = {}
+        self._waiters = {}
+        self._counter = itertools.count()
+
+    def compress(self, source_path, callback):
+        """Calls `callback` with the path and "compressed_" keys of the gzipped copy of the file
+           given by `source_path`, or None if compression is not worthwhile.
+        """
+        with self._lock:
+            if source_path in self._waiters:
+                self._waiters[source_path].append(callback)
+                return
+            if source_path not in self._results:
+                self._waiters[source_path] = [callback]
+                temp_path = self._temp_path.joinpath(f"{next(self._counter)}.gz")
+                self._pipeline.submit(self._pipeline.pool, "compress", _utils.gzip_file,
+                                      (source_path, temp_path, self._min_savings),
+                                      functools.partial(self._on_compressed, source_path, temp_path),
+                                      functools.partial(self._on_failed, source_path))
+                return
+            result = self._results[source_path]
+        callback(result)
+
+    def _on_compressed(self, source_path, temp_path, compressed):
+        result = (temp_path, compressed) if compressed is not None else None
+        with self._lock:
+            self._results[source_path] = result
+            waiters = self._waiters.pop(source_path)
+        for i in waiters:
+            i(result)
+
+    def _on_failed(self, source_path, ex):
+        logging.exception(ex)
+        self._on_compressed(source_path, None, None)
+
 
 def make_asset_path(asset_category, *filename_pieces, **kwargs):
     subdir = client_subdirectories[asset_category]
@@ -290,162 +596,717 @@ def make_asset_path(asset_category, *filename_pieces, **kwargs):
     else:
         return kwargs["client_path"].joinpath(subdir, *filename_pieces)
 
-def output_package(output, yaml, outfile, client_path, scripts_path, subpackage_name=""):
+def load_previous_package(outfile, yaml):
+    """Loads the asset dicts of a previous build at the destination keyed by their path in the
+       bundle, including the compressed copies. The path of each package YAML file is also
+       present, mapping to None.
+    """
+    previous = {}
+
+    def _load(yaml_path):
+        with outfile.open(yaml_path, "r") as stream:
+            package = yaml.load(stream)
+        previous[yaml_path] = None
+
+        for i in package.pop("subpackages", []):
+            _load(yaml_path.parent.joinpath(*pathlib.PureWindowsPath(i["source"]).parts))
+        for assets in package.values():
+            for asset_dict in assets.values():
+                asset_path = yaml_path.parent.joinpath(*pathlib.PureWindowsPath(asset_dict["source"]).parts)
+                previous[asset_path] = asset_dict
+                if "compressed_source" in asset_dict:
+                    compressed_path = yaml_path.parent.joinpath(*pathlib.PureWindowsPath(asset_dict["compressed_source"]).parts)
+                    previous[compressed_path] = asset_dict
+
+    if outfile.stat("contents.yml") is not None:
+        _load(pathlib.Path("contents.yml"))
+    return previous
+
+def _package_paths(package_dict, subpackage_name=""):
+    """Yields the path of each file written for a package along with its asset dict, or None for
+       the package YAML itself.
+    """
+    base_path = pathlib.Path(subpackage_name)
+    yield base_path.joinpath("contents.yml"), None
+    for assets in package_dict.values():
+        for asset_dict in assets.values():
+            for key in ("source", "compressed_source"):
+                if key in asset_dict:
+                    yield base_path.joinpath(*pathlib.PureWindowsPath(asset_dict[key]).parts), asset_dict
+
+def make_previous_package(all_outputs, flatten=True):
+    """Builds the same mapping as `load_previous_package()` from the packages as they were last
+       written by `output_packages()`, without reading anything back from the destination.
+    """
+    if flatten and len(all_outputs) == 1:
+        return dict(_package_paths(next(iter(all_outputs.values()))))
+    previous = { pathlib.Path("contents.yml"): None }
+    for package_name, package_dict in all_outputs.items():
+        previous.update(_package_paths(package_dict, package_name))
+    return previous
+
+def is_asset_current(outfile, asset_dest_path, asset_dict, previous_dict):
+    """Determines if the destination already holds an identical copy of the asset."""
+    if previous_dict is None or "hash_sha2" not in asset_dict:
+        return False
+    if any(asset_dict.get(key) != previous_dict.get(key) for key in ("size", "hash_sha2")):
+        return False
+    stat = outfile.stat(asset_dest_path)
+    return stat is not None and stat.st_size == asset_dict["size"]
+
+def output_package(output, pipeline, outfile, client_path, scripts_path, subpackage_name="", previous=None,
+                   unchanged=None, failures=None, compressor=None):
+    """Queues the copies of a single package's assets to `outfile`, returning the paths of all
+       files that belong to it, which are only complete once the pipeline has drained. If a
+       `previous` build is given or the output is deduplicated, assets are only copied once their
+       digests are known, and unchanged assets are skipped. If a `compressor` is given, compressed
+       copies are written alongside the assets. The destination paths of assets that were left
+       alone and of failed copies are appended to `unchanged` and `failures`.
+    """
+    written = set()
+
+    def _copy(asset_source_path, asset_dest_path, hash_sha2=None, asset_dict=None):
+        callback = functools.partial(_on_copied, asset_dest_path, asset_dict) if asset_dict is not None else None
+        pipeline.submit(pipeline.io_pool, "copy", outfile.copy_file, (asset_source_path, asset_dest_path, hash_sha2),
+                        callback=callback, error_callback=functools.partial(_copy_failed, asset_dest_path))
+
+    def _on_copied(asset_dest_path, asset_dict, result):
+        _update_modify_time(asset_dest_path, asset_dict)
+
+    def _update_modify_time(asset_dest_path, asset_dict):
+        # A quick verify compares this to the file in the package, which may be a copy from the
+        # previous build or linked to another asset's copy, rather than to the client's file.
+        stat = outfile.stat(asset_dest_path)
+        if stat is not None:
+            asset_dict["modify_time"] = int(stat.st_mtime)
+
+    def _copy_failed(asset_dest_path, ex):
+        logging.error(f"Failed to write '{asset_dest_path}': {ex}")
+        failures.append(asset_dest_path)
+
+    def _compress(asset_source_path, asset_dest_path, asset_dict):
+        if compressor is not None:
+            compressor.compress(asset_source_path, functools.partial(_on_compressed, asset_dest_path, asset_dict))
+
+    def _on_compressed(asset_dest_path, asset_dict, result):
+        # Tell the file server not to bother compressing this asset itself.
+        if result is None:
+            asset_dict["compression"] = str(Compression.none)
+            return
+
+        temp_path, compressed = result
+        compressed_dest_path = asset_dest_path.with_name(f"{asset_dest_path.name}.gz")
+        asset_dict["compressed_source"] = f"{asset_dict['source']}.gz"
+        asset_dict["compression"] = str(Compression.gzip)
+        asset_dict.update(compressed)
+        written.add(compressed_dest_path)
+        _copy(temp_path, compressed_dest_path, compressed["compressed_hash_sha2"])
+
+    def _reuse_compressed(asset_dest_path, asset_dict, previous_dict):
+        """Carries a compressed copy from the previous build over to an unchanged asset."""
+        if previous_dict.get("compression") == str(Compression.none):
+            asset_dict["compression"] = previous_dict["compression"]
+            return True
+        if "compressed_source" not in previous_dict:
+            return False
+        compressed_dest_path = asset_dest_path.with_name(f"{asset_dest_path.name}.gz")
+        stat = outfile.stat(compressed_dest_path)
+        if stat is None or stat.st_size != previous_dict.get("compressed_size"):
+            return False
+
+        asset_dict["compressed_source"] = f"{asset_dict['source']}.gz"
+        for key in ("compression", "compressed_hash_md5", "compressed_hash_sha2", "compressed_size"):
+            if key in previous_dict:
+                asset_dict[key] = previous_dict[key]
+        written.add(compressed_dest_path)
+        outfile.add_existing_file(compressed_dest_path, asset_dict["compressed_hash_sha2"])
+        return True
+
+    def _copy_if_changed(asset_source_path, asset_dest_path, asset_dict, hashes):
+        previous_dict = previous.get(asset_dest_path) if previous is not None else None
+        if is_asset_current(outfile, asset_dest_path, asset_dict, previous_dict):
+            unchanged.append(asset_dest_path)
+            outfile.add_existing_file(asset_dest_path, asset_dict["hash_sha2"])
+            _update_modify_time(asset_dest_path, asset_dict)
+            if compressor is not None and not _reuse_compressed(asset_dest_path, asset_dict, previous_dict):
+                _compress(asset_source_path, asset_dest_path, asset_dict)
+        else:
+            # Deduplicated copies may be linked to a file with another modify time.
+            _copy(asset_source_path, asset_dest_path, hashes["hash_sha2"] if hashes is not None else None,
+                  asset_dict if outfile.dedup else None)
+            _compress(asset_source_path, asset_dest_path, asset_dict)
+
     for asset_category, assets in output.items():
-        src_subdir = client_subdirectories[asset_category]
         dest_subdir = asset_subdirectories[asset_category]
         for asset_filename, asset_dict in assets.items():
             asset_dict["source"] = str(pathlib.PureWindowsPath(dest_subdir, asset_filename))
+            asset_dest_path = pathlib.Path(subpackage_name, dest_subdir, asset_filename)
+            written.add(asset_dest_path)
+
             asset_source_path = make_asset_path(asset_category, asset_filename,
                                                 client_path=client_path, scripts_path=scripts_path)
-            asset_dest_path = pathlib.Path(subpackage_name, dest_subdir, asset_filename)
-            outfile.copy_file(asset_source_path, asset_dest_path)
+            if previous is None and not outfile.dedup:
+                _copy(asset_source_path, asset_dest_path)
+                _compress(asset_source_path, asset_dest_path, asset_dict)
+            else:
+                pipeline.on_hashed(asset_source_path, functools.partial(_copy_if_changed, asset_source_path,
+                                                                        asset_dest_path, asset_dict))
+
+    return written
+
+def output_packages(all_outputs, pipeline, client_path, scripts_path, destination_path, incremental=False,
+                    dedup=False, compression=Compression.none, compress_min_savings=0.0, client_paths={},
+                    flatten=True, previous_outputs=None, updated=None):
+    """Writes all packages to the destination, returning False if any file could not be written.
+       Packages named in `client_paths` are sourced from that client instead of `client_path`.
+       If `flatten`, a lone package is written to the root of the destination.
+
+       If the packages were last written from `previous_outputs`, the destination is updated
+       from those instead of the YAML on disk. Only the packages named in `updated` (or all of
+       them, if None) are written, and the rest are assumed to be unchanged since then.
+    """
+    yaml = YAML()
 
-    path = pathlib.Path(subpackage_name, "contents.yml")
-    yaml.dump(output, outfile.open(path, "w"))
+    with contextlib.ExitStack() as stack:
+        outfile = stack.enter_context(_utils.OutputManager(destination_path, dedup))
+        if compression == Compression.gzip:
+            temp_path = stack.enter_context(tempfile.TemporaryDirectory(dir=destination_path.parent))
+            compressor = AssetCompressor(pipeline, pathlib.Path(temp_path), compress_min_savings)
+        else:
+            compressor = None
 
-def output_packages(all_outputs, client_path, scripts_path, destination_path):
-    yaml = YAML()
+        if previous_outputs is not None:
+            previous = make_previous_package(previous_outputs, flatten)
+        elif incremental:
+            previous = load_previous_package(outfile, yaml)
+        else:
+            previous = None
+        written = set()
+        package_written = []
+        unchanged, failures = [], []
 
-    with _utils.OutputManager(destination_path) as outfile:
         # If we only have one package, we'll just toss that single package out into the destination
-        if len(all_outputs) == 1:
-            package_dict = all_outputs.get(next(iter(all_outputs)))
+        if flatten and len(all_outputs) == 1:
+            package_name = next(iter(all_outputs))
+            subpackages = { "": all_outputs[package_name] }
+            package_client_paths = { "": client_paths.get(package_name, client_path) }
             logging.info("Writing package...")
-            output_package(package_dict, yaml, outfile,client_path, scripts_path)
         else:
-            for package_name, package_dict in all_outputs.items():
+            subpackages = all_outputs
+            package_client_paths = { i: client_paths.get(i, client_path) for i in all_outputs.keys() }
+        # Packages that haven't changed since `previous_outputs` are left as they are. A lone
+        # package is always written, since there would be nothing to update otherwise.
+        skipped = { i for i in subpackages.keys() if i and updated is not None and i not in updated }
+        kept = set()
+        for package_name, package_dict in subpackages.items():
+            if package_name in skipped:
+                kept.update(path for path, _ in _package_paths(package_dict, package_name))
+                continue
+            if package_name:
                 logging.info(f"Writing subpackage '{package_name}'...")
-                output_package(package_dict, yaml, outfile, client_path, scripts_path, package_name)
+            package_written.append(output_package(package_dict, pipeline, outfile, package_client_paths[package_name],
+                                                  scripts_path, package_name, previous, unchanged, failures,
+                                                  compressor))
+
+        # The package descriptors need the digests of every asset.
+        pipeline.wait("hash", "compress", "copy")
+        for i in package_written:
+            written.update(i)
+        if previous is not None:
+            logging.debug(f"Copied {len(written) - len(unchanged)} assets, {len(unchanged)} unchanged.")
+        index_packages = []
+        for package_name, package_dict in subpackages.items():
+            path = pathlib.Path(package_name, "contents.yml")
+            index_packages.append((package_name if package_name else None, path, package_dict))
+            if package_name in skipped:
+                continue
+            # The keys of each asset are filled in by the pipeline in no particular order.
+            for assets in package_dict.values():
+                for asset_filename, asset_dict in assets.items():
+                    assets[asset_filename] = dict(sorted(asset_dict.items()))
+            write_yaml(package_dict, yaml, outfile, path, previous)
+            written.add(path)
 
-            # Write bundle descriptor yaml
+        # Write bundle descriptor yaml
+        if len(subpackages) > 1 or not flatten:
             bundle = [{ "name": i, "source": str(pathlib.PureWindowsPath(i, "contents.yml")) } for i in all_outputs.keys()]
-            yaml.dump({"subpackages": bundle}, outfile.open("contents.yml", "w"))
+            path = pathlib.Path("contents.yml")
+            write_yaml({"subpackages": bundle}, yaml, outfile, path, previous)
+            written.add(path)
+            index_packages.insert(0, (None, path, {}))
+
+        # Consumers can look up single assets in the index without parsing all of the YAML.
+        _index.write_index(outfile, index_packages)
+        written.add(pathlib.Path(_index.INDEX_FILENAME))
+
+        # Anything left over from the previous build is no longer a part of the package.
+        if previous is not None:
+            stale_paths = previous.keys() - written - kept
+            if stale_paths:
+                logging.info(f"Removing {len(stale_paths)} files from the previous build...")
+            for i in stale_paths:
+                logging.debug(f"Removing '{i}'")
+                outfile.remove_file(i)
+
+    return not failures
+
+def write_yaml(data, yaml, outfile, path, previous=None):
+    with io.StringIO() as stream:
+        yaml.dump(data, stream)
+        contents = stream.getvalue()
+
+    # Leave identical YAML files from the previous build alone.
+    if previous is not None and path in previous:
+        with outfile.open(path, "r") as stream:
+            if stream.read() == contents:
+                return
+    outfile.write_file(path, contents)
+
+def list_client_directories(pipeline, client_path, scripts_path, extra_client_paths=[]):
+    """Lists every directory that assets are taken from in the pipeline's I/O pool. Returns the
+       (path, recursive) directories that were listed.
+    """
+    directories = []
+    for asset_category, subdir in client_subdirectories.items():
+        # The client root has everything under it, so only its own files are wanted.
+        directories.append((make_asset_path(asset_category, client_path=client_path, scripts_path=scripts_path), bool(subdir)))
+    for path in itertools.chain((client_path,), extra_client_paths):
+        directories.append((path.joinpath("extras"), True))
+    for path in extra_client_paths:
+        directories.append((path, False))
+    pipeline.list_directories(directories)
+    return directories
+
+def add_package_assets(pipeline, all_outputs, client_path, scripts_path, client_paths={}):
+    """Starts collecting the stat and digests of every asset currently in the packages."""
+    for package_name, package_dict in all_outputs.items():
+        package_client_path = client_paths.get(package_name, client_path)
+        for asset_category, assets in package_dict.items():
+            for asset_filename in assets.keys():
+                pipeline.add_asset(make_asset_path(asset_category, asset_filename,
+                                                   client_path=package_client_path, scripts_path=scripts_path))
+
+def prepare_packages(all_outputs, pipeline, client_path, scripts_path, client_paths={}, **kwargs):
+    """Fills in the filesystem information of each asset and discards any missing assets. The
+       digests are filled in by the pipeline as they become available. Packages named in
+       `client_paths` are sourced from that client instead of `client_path`.
+    """
+    # Everything needed to find the missing assets is cheap filesystem work.
+    pipeline.wait("stat")
+
+    missing_assets = []
+    for package_name, package_dict in all_outputs.items():
+        package_client_path = client_paths.get(package_name, client_path)
+        for asset_category, assets in package_dict.items():
+            for asset_filename, asset_dict in assets.items():
+                asset_source_path = make_asset_path(asset_category, asset_filename,
+                                                    client_path=package_client_path,
+                                                    scripts_path=scripts_path)
+                stat = pipeline.get_stat(asset_source_path)
+                if stat is None:
+                    missing_assets.append((package_name, asset_category, asset_filename))
+                    logging.warning(f"Asset '{asset_source_path.name}' (used in '{package_name}') is missing from the client.")
+                    continue
+
+                # Fill in some information from the filesystem.
+                asset_dict["modify_time"] = int(stat.st_mtime)
+                asset_dict["size"] = stat.st_size
+
+                # Command line specs
+                for key, value in kwargs.items():
+                    if value is not None:
+                        asset_dict[key] = str(value)
+
+                # The same file may be used by multiple packages, but it is only hashed once.
+                pipeline.on_hashed(asset_source_path, functools.partial(_on_asset_hashed, asset_dict))
+
+    # Discard any missing thingos from our asset map and it will be very nearly final.
+    for package_name, asset_category, asset_filename in missing_assets:
+        all_outputs[package_name][asset_category].pop(asset_filename)
+    for package_name in tuple(all_outputs.keys()):
+        package_dict = all_outputs[package_name]
+        for asset_category in tuple(package_dict.keys()):
+            if not package_dict[asset_category]:
+                package_dict.pop(asset_category)
+        if not package_dict:
+            all_outputs.pop(package_name)
+
+        # Assets are discovered in whatever order the pipeline finishes them, so sort everything
+        # to keep the package descriptors stable between runs.
+        else:
+            all_outputs[package_name] = { asset_category: dict(sorted(package_dict[asset_category].items()))
+                                          for asset_category in sorted(package_dict.keys()) }
 
-def prepare_packages(all_outputs, client_path, scripts_path, **kwargs):
-    pool = multiprocessing.pool.Pool(initializer=_utils.multiprocess_init)
-    try:
-        missing_assets = []
-        for package_name, package_dict in all_outputs.items():
-            for asset_category, assets in package_dict.items():
-                for asset_filename, asset_dict in assets.items():
-                    asset_source_path = make_asset_path(asset_category, asset_filename,
-                                                        client_path=client_path,
-                                                        scripts_path=scripts_path)
-                    if not asset_source_path.exists():
-                        missing_assets.append((package_name, asset_category, asset_filename))
-                        logging.warning(f"Asset '{asset_source_path.name}' (used in '{package_name}') is missing from the client.")
-                        continue
-
-                    # Fill in some information from the filesystem.
-                    stat = asset_source_path.stat()
-                    asset_dict["modify_time"] = int(stat.st_mtime)
-                    asset_dict["size"] = stat.st_size
-
-                    # Command line specs
-                    for key, value in kwargs.items():
-                        if value is not None:
-                            asset_dict[key] = str(value)
-
-                    # Now we submit slow operations to the process pool.
-                    def pool_cb(asset_dict, key, value):
-                        asset_dict[key] = value
-                    md5_complete = functools.partial(pool_cb, asset_dict, "hash_md5")
-                    sha2_complete = functools.partial(pool_cb, asset_dict, "hash_sha2")
-
-                    pool.apply_async(_utils.hash_md5, (asset_source_path,),
-                                     callback=md5_complete, error_callback=log_exception)
-                    pool.apply_async(_utils.hash_sha2, (asset_source_path,),
-                                     callback=sha2_complete, error_callback=log_exception)
-
-        # Discard any missing thingos from our asset map and it will be very nearly final.
-        for package_name, asset_category, asset_filename in missing_assets:
-            all_outputs[package_name][asset_category].pop(asset_filename)
-        for package_name in tuple(all_outputs.keys()):
-            package_dict = all_outputs[package_name]
-            for asset_category in tuple(package_dict.keys()):
-                if not package_dict[asset_category]:
-                    package_dict.pop(asset_category)
-            if not package_dict:
-                all_outputs.pop(package_name)
-    except:
-        pool.terminate()
-        pool.join()
-        raise
-    else:
-        # Wait for the pool to finish
-        pool.close()
-        pool.join()
+    return not bool(missing_assets)
 
-        return not bool(missing_assets)
+def _on_asset_hashed(asset_dict, hashes):
+    if hashes is not None:
+        asset_dict.update(hashes)
 
 def main(args):
     if args.moul_scripts and not args.moul_scripts.exists():
         logging.error(f"Scripts path '{args.moul_scripts}' does not exist.")
         return False
-
-    if args.age:
-        age_info = load_age(make_asset_path("data", f"{args.age}.age", client_path=args.source))
-        if age_info is None:
-            return False
-        age_infos = (age_info,)
-    elif not args.no_ages:
-        logging.info("Loading age files...")
-        age_source_path = make_asset_path("data", client_path=args.source)
-        age_infos = [load_age(age_file_path) for age_file_path in age_source_path.glob("*.age")]
-        if not age_infos:
-            logging.warning("No age files found in client!")
-            return True
-        elif not all(age_infos):
+    if args.incremental and args.destination.suffix.lower() == ".zip":
+        logging.error("Incremental packaging is not supported for zip files.")
+        return False
+    if args.dedup and args.destination.suffix.lower() == ".zip":
+        logging.error("Deduplicated packaging is not supported for zip files.")
+        return False
+    if args.watch and args.destination.suffix.lower() == ".zip":
+        logging.error("Watching is not supported for zip files.")
+        return False
+    if args.watch and args.shard is not None:
+        logging.error("Watching is not supported for sharded packaging.")
+        return False
+    client_archs = [args.client_arch] + [arch for arch, path in args.extra_client]
+    if len(set(client_archs)) != len(client_archs):
+        logging.error("Each client architecture may only be packaged once.")
+        return False
+    for arch, path in args.extra_client:
+        if not path.is_dir():
+            logging.error(f"Client path '{path}' for {arch} does not exist.")
             return False
-    else:
-        age_infos = []
-
-    # Collect a list of all age pages to be abused for the purpose of finding its resources
-    # Would be nice if this were a common function of libHSPlasma...
-    all_outputs = {}
-    all_pages = [i for i in find_all_pages(all_outputs, make_asset_path("data", client_path=args.source), *age_infos)]
-    logging.info(f"Found {len(all_pages)} Plasma pages.")
-
-    # We want to get the age dependency data. Presently, those are the python and ogg files.
-    # Unfortunately, libHSPlasma insists on reading in the entire page before allowing us to
-    # do any of that. So, we will execute this part in a process pool.
-    pool =  multiprocessing.pool.Pool(initializer=_utils.multiprocess_init)
-    try:
-        dlevel = plDebug.kDLWarning if args.verbose else plDebug.kDLNone
-        results = pool.starmap(find_page_externals, ((page_path, dlevel) for age_name, page_path in all_pages))
-    except:
-        pool.terminate()
-        pool.join()
-        raise
 
-    # What we have now is a list of dicts, each nearly obeying the output format spec.
-    # Now, we have to merge them... ugh.
-    logging.info(f"Merging results from {len(results)} dependency lists...")
-    coerce_asset_dicts(all_outputs, all_pages, results)
+    with _profile.open_profiler(args) as profiler:
+        with _profile.stage(profiler, "load_ages"):
+            if args.age:
+                age_path = make_asset_path("data", f"{args.age}.age", client_path=args.source)
+                if _utils.stat_file(age_path) is None:
+                    logging.critical(f"Age file '{age_path}' does not exist.")
+                    return False
+                age_info = load_age(age_path)
+                if not age_info:
+                    return False
+                age_infos = (age_info,)
+            elif not args.no_ages:
+                logging.info("Loading age files...")
+                age_source_path = make_asset_path("data", client_path=args.source)
+                age_infos = [load_age(age_file_path) for age_file_path in age_source_path.glob("*.age")]
+                if not age_infos:
+                    logging.warning("No age files found in client!")
+                    return True
+                elif not all(age_infos):
+                    return False
+            else:
+                age_infos = []
+
+        with _cache.open_cache(args) as cache:
+            return make_package(args, age_infos, cache, profiler)
+
+def find_packages(args, pipeline, resolver, sdl_index, age_infos, package_client, profiler=None):
+    """Finds every asset of the ages in `age_infos` and, if `package_client`, the client. Returns
+       the packages along with the client paths of any packages sourced from another client.
+    """
+    with _profile.stage(profiler, "find_pages"):
+        # Collect a list of all age pages to be abused for the purpose of finding its resources
+        all_outputs = {}
+        all_pages = [i for i in find_all_pages(all_outputs, make_asset_path("data", client_path=args.source),
+                                               *age_infos, stat=pipeline.stat)]
+        logging.info(f"Found {len(all_pages)} Plasma pages.")
+
+        # The scans are the longest chain of work in the run, so they go in the pool ahead of
+        # everything else. The biggest pages start first so that none are left running alone
+        # at the end while the smaller ones fill in around them.
+        logging.info("Searching for page and PythonFileMod dependencies...")
+        all_pages.sort(key=lambda x: pipeline.stat(x[1]).st_size, reverse=True)
+        if pipeline.cache is not None:
+            # Cached scans are looked up by the page hashes, so those are hashed before anything
+            # the scans turn up.
+            for age_name, page_path in all_pages:
+                pipeline.add_asset(page_path)
+        for age_name, page_path in all_pages:
+            resolver.scan_page(all_outputs[age_name], page_path)
+
+    with _profile.stage(profiler, "find_client"):
+        # Gather client exes, DLLs, and installers. Everything else is shared by all of the clients.
+        client_paths = {}
+        if package_client:
+            logging.info("Searching for client files...")
+            clients = [(args.source, args.client_arch)] + [(path, arch) for arch, path in args.extra_client]
+            client_paths = find_client_dependencies(all_outputs, clients, args.moul_scripts, sdl_index,
+                                                    list_files=pipeline.list_files)
+        resolver.add_package_assets(all_outputs, client_paths)
+
+    with _profile.stage(profiler, "scan_pages"):
+        pipeline.wait("scan")
+        resolver.log_page_times(args.jobs or os.cpu_count())
+    with _profile.stage(profiler, "resolve_pfms"):
+        pipeline.wait("scan", "pfm")
+        if pipeline.cache is not None:
+            logging.info(f"Page scan cache: {resolver.page_hits} hits, {resolver.page_misses} misses.")
+
+        if not args.no_pfm_dependencies and not args.no_pfm_sdl_dependencies:
+            for age_info in age_infos:
+                output = all_outputs[age_info.name]
+                pfm_names = [pathlib.Path(asset_filename).stem
+                             for asset_filename, asset_dict in output.get("python", {}).items()
+                             if "pfm" in asset_dict.get("options", [])]
+                for i in find_pfm_sdlmods(sdl_index, pfm_names):
+                    resolver.add_asset(output, "sdl", str(i.relative_to(sdl_index.path)), {})
+
+    return all_outputs, client_paths
+
+def find_package_sources(all_outputs, age_infos, client_path, scripts_path, client_paths={}):
+    """Returns the paths of every file that each package was built from, including the assets
+       that turned out to be missing, which the packages no longer list.
+    """
+    sources = {}
+    for package_name, package_dict in all_outputs.items():
+        package_client_path = client_paths.get(package_name, client_path)
+        sources[package_name] = { make_asset_path(asset_category, asset_filename,
+                                                  client_path=package_client_path, scripts_path=scripts_path)
+                                  for asset_category, assets in package_dict.items() for asset_filename in assets.keys() }
+    data_path = make_asset_path("data", client_path=client_path)
+    for age_info in age_infos:
+        sources.setdefault(age_info.name, set()).update(_generate_page_paths(age_info, data_path))
+    return sources
 
+def make_package(args, age_infos, cache=None, profiler=None):
     # PythonFileMods can import other python modules and be a STATEDESC
-    if not args.no_pfm_dependencies:
+    py_exe = None
+    if not args.no_pfm_dependencies and not args.no_pfm_py_dependencies:
         py_exe = args.python if args.python else _utils.find_python_exe()
         if not py_exe:
             logging.critical("Uru-compatible python interpreter unavailable.")
             return False
-        logging.info("Searching for PythonFileMod dependencies...")
-        find_pfm_externals(all_outputs, py_exe, args.no_pfm_py_dependencies, args.no_pfm_sdl_dependencies,
-                           make_asset_path("python", client_path=args.source, scripts_path=args.moul_scripts),
-                           make_asset_path("sdl", client_path=args.source, scripts_path=args.moul_scripts))
-
-    # Gather client exes, DLLs, and installers.
-    if not args.no_client:
-        logging.info("Searching for client files...")
-        find_client_dependencies(all_outputs, args.source, args.moul_scripts, args.client_arch)
 
-    # OK, now everything is (mostly) sane.
-    logging.info("Beginning final pass over assets...")
-    prepare_packages(all_outputs, args.source, args.moul_scripts, dataset=args.dataset, distribute=args.distribute)
+    # Only the first shard of a sharded build packages the client, so that it is only built once.
+    package_client = not args.no_client and (args.shard is None or args.shard[0] == 1)
 
-    # Time to produce the bundle
-    logging.info("Producing final asset bundle...")
-    output_packages(all_outputs, args.source, args.moul_scripts, args.destination)
+    # Everything from here on out streams through a single set of pools, so that pages are
+    # parsed, dependencies resolved, and assets hashed and copied all at the same time.
+    with _pipeline.Pipeline(args.jobs, args.io_jobs, cache, profiler) as pipeline:
+        # We want to get the age dependency data. Presently, those are the python and ogg files.
+        # Unfortunately, libHSPlasma insists on reading in the entire page before allowing us to
+        # do any of that. So, we will execute this part in the process pool, and merge the results
+        # as each page finishes.
+        dlevel = plDebug.kDLWarning if args.verbose else plDebug.kDLNone
+        with DependencyResolver(pipeline, args.source, args.moul_scripts, dlevel, py_exe) as resolver:
+            with _profile.stage(profiler, "list_client"):
+                # Everything is looked up in directory listings, which is much faster than looking up
+                # each file, especially on network shares.
+                directories = list_client_directories(pipeline, args.source, args.moul_scripts,
+                                                      [path for arch, path in args.extra_client] if package_client else [])
+
+                if args.shard is not None:
+                    shard_index, shard_count = args.shard
+                    age_infos = partition_ages(age_infos, make_asset_path("data", client_path=args.source),
+                                               shard_count, stat=pipeline.stat)[shard_index - 1]
+                    logging.info(f"Packaging {len(age_infos)} ages in shard {shard_index} of {shard_count}.")
+
+            # The SDL descriptors are shared by the PythonFileMods and the client.
+            sdl_index = SDLIndex(make_asset_path("sdl", client_path=args.source, scripts_path=args.moul_scripts))
+            all_outputs, client_paths = find_packages(args, pipeline, resolver, sdl_index, age_infos, package_client, profiler)
+            sources = find_package_sources(all_outputs, age_infos, args.source, args.moul_scripts, client_paths) if args.watch else None
+
+            # OK, now everything is (mostly) sane.
+            logging.info("Beginning final pass over assets...")
+            with _profile.stage(profiler, "prepare"):
+                prepare_packages(all_outputs, pipeline, args.source, args.moul_scripts, client_paths,
+                                 dataset=args.dataset, distribute=args.distribute)
+
+            # Time to produce the bundle
+            logging.info("Producing final asset bundle...")
+            with _profile.stage(profiler, "output"):
+                result = output_packages(all_outputs, pipeline, args.source, args.moul_scripts, args.destination,
+                                         args.incremental, args.dedup, args.compress, args.compress_min_savings / 100, client_paths,
+                                         flatten=args.shard is None)
+
+            if cache is not None:
+                logging.info(f"Hash cache: {cache.hash_hits} hits, {cache.hash_misses} misses.")
+
+            if args.watch:
+                watcher = PackageWatcher(args, pipeline, resolver, sdl_index, directories, age_infos,
+                                         all_outputs, client_paths, sources)
+                result = watcher.run() and result
+        return result
+
+
+class _ChangeNotifier:
+    """Wakes up the watcher whenever the filesystem reports a change in any of the (path, recursive)
+       directories, so that they need not be listed again until something actually happened.
+    """
+
+    def __init__(self, directories):
+        self._directories = directories
+        self._event = threading.Event()
+        self._observer = Observer()
+        self._watched = set()
+
+    def __enter__(self):
+        self.watch()
+        self._observer.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._observer.stop()
+        self._observer.join()
+        return False
 
-    return True
+    def dispatch(self, event):
+        # Called by the observer thread for every event, which is all the handler needs to do.
+        self._event.set()
+
+    def watch(self):
+        """Watches each directory, or the closest parent that exists, so that creating a missing
+           directory is noticed too.
+        """
+        watched = set()
+        for path, recursive in self._directories:
+            while not path.is_dir() and path.parent != path:
+                path, recursive = path.parent, False
+            watched.add((path, recursive))
+        if watched != self._watched:
+            self._observer.unschedule_all()
+            for path, recursive in sorted(watched):
+                self._observer.schedule(self, str(path), recursive=recursive)
+            self._watched = watched
+
+    def wait(self):
+        # Waiting in short steps keeps Ctrl+C working on Windows.
+        while not self._event.wait(1.0):
+            pass
+
+    def clear(self):
+        self._event.clear()
+
+
+class PackageWatcher:
+    """Keeps everything known about a finished build and watches the client for changes, updating
+       only the packages built from the changed files. Pages that did not change are never
+       scanned again, and files that did not change are never hashed or copied again. The client
+       is listed again only when watchdog reports a change, or every `--watch-interval` without it.
+    """
+
+    def __init__(self, args, pipeline, resolver, sdl_index, directories, age_infos, all_outputs,
+                 client_paths, sources):
+        self._args = args
+        self._pipeline = pipeline
+        self._resolver = resolver
+        self._sdl_index = sdl_index
+        self._directories = directories
+        self._age_infos = { i.name: i for i in age_infos }
+        self._all_outputs = all_outputs
+        self._client_paths = client_paths
+        self._sources = sources
+        self._data_path = make_asset_path("data", client_path=args.source)
+
+        # The client packages also pick up anything new in these directories.
+        self._client_packages = { i for i in all_outputs.keys() if i not in self._age_infos }
+        py_path = make_asset_path("python", client_path=args.source, scripts_path=args.moul_scripts)
+        client_roots = [args.source] + [path for arch, path in args.extra_client]
+        self._client_directories = { py_path.joinpath("plasma"), py_path.joinpath("system"),
+                                     make_asset_path("avi", client_path=args.source) }
+        self._client_directories.update(client_roots)
+        self._client_directories.update(i.joinpath("extras") for i in client_roots)
+
+    def run(self):
+        """Updates the destination until interrupted. Returns False if any update failed."""
+        logging.info("Watching the client for changes, press Ctrl+C to stop...")
+        result = True
+        with contextlib.ExitStack() as stack:
+            notifier = None
+            if Observer is not None:
+                try:
+                    notifier = stack.enter_context(_ChangeNotifier(self._directories))
+                except OSError as ex:
+                    logging.warning(f"Could not watch the client for changes, polling it instead: {ex}")
+            else:
+                logging.debug("watchdog is not installed, polling the client for changes.")
+            try:
+                while True:
+                    changed = self._poll(notifier)
+                    if changed:
+                        result = self.update(changed) and result
+            except KeyboardInterrupt:
+                logging.info("Stopped watching the client.")
+        return result
+
+    def _poll(self, notifier=None):
+        changed = set()
+        while True:
+            if notifier is not None and not changed:
+                notifier.wait()
+            time.sleep(self._args.watch_interval)
+            if notifier is not None:
+                # Anything that happens from here on is caught by the next listing or wakes us again.
+                notifier.clear()
+                notifier.watch()
+            new_changes = self._pipeline.update_directories(self._directories)
+            if not new_changes:
+                return changed
+            # Editors and exporters tend to write several files in a row, so wait for them to
+            # settle before doing anything.
+            changed.update(new_changes)
+
+    def _affected_packages(self, changed):
+        affected = { package_name for package_name, sources in self._sources.items() if sources & changed }
+        # The interpreters compile the modules they import, which is not a change worth packaging.
+        if self._client_packages and any(i.parent in self._client_directories and i.suffix.lower() not in {".pyc", ".pyo"}
+                                         for i in changed):
+            affected.update(self._client_packages)
+
+        # Ages that were added, removed, or whose pages changed.
+        if not self._args.no_ages:
+            for path in changed:
+                if path.parent != self._data_path or path.suffix.lower() != ".age":
+                    continue
+                age_name = path.stem
+                if self._args.age and age_name.lower() != self._args.age.lower():
+                    continue
+                age_info = load_age(path) if self._pipeline.stat(path) is not None else None
+                if age_info:
+                    self._age_infos[age_name] = age_info
+                else:
+                    self._age_infos.pop(age_name, None)
+                affected.add(age_name)
+        return affected
+
+    def update(self, changed):
+        """Updates the packages built from the files given by `changed`. Returns False if the
+           destination could not be updated.
+        """
+        start = time.perf_counter()
+        args = self._args
+        self._resolver.forget(changed)
+        if any(i.suffix.lower() == ".sdl" for i in changed):
+            self._sdl_index = SDLIndex(self._sdl_index.path)
+
+        affected = self._affected_packages(changed)
+        if not affected:
+            logging.debug(f"{len(changed)} files changed, but no packages use them.")
+            return True
+        logging.info(f"Updating {', '.join(sorted(affected))}...")
+
+        age_infos = [age_info for age_name, age_info in self._age_infos.items() if age_name in affected]
+        package_client = bool(affected & self._client_packages)
+        outputs, client_paths = find_packages(args, self._pipeline, self._resolver, self._sdl_index,
+                                              age_infos, package_client)
+        for package_name in affected:
+            self._sources.pop(package_name, None)
+        self._sources.update(find_package_sources(outputs, age_infos, args.source, args.moul_scripts, client_paths))
+        if package_client:
+            self._client_paths = client_paths
+            self._client_packages = { i for i in outputs.keys() if i not in self._age_infos }
+        prepare_packages(outputs, self._pipeline, args.source, args.moul_scripts, self._client_paths,
+                         dataset=args.dataset, distribute=args.distribute)
+
+        # Everything stays in the order it was first packaged in, so the bundle doesn't churn.
+        all_outputs = { package_name: outputs.get(package_name) if package_name in affected else package_dict
+                        for package_name, package_dict in self._all_outputs.items() }
+        all_outputs.update((package_name, package_dict) for package_name, package_dict in outputs.items()
+                           if package_name not in all_outputs)
+        all_outputs = { package_name: package_dict for package_name, package_dict in all_outputs.items()
+                        if package_dict is not None }
+
+        # A lone package is written to the root of the destination, so if that changes, every
+        # package moves.
+        moved = (len(all_outputs) == 1) != (len(self._all_outputs) == 1)
+        result = output_packages(all_outputs, self._pipeline, args.source, args.moul_scripts, args.destination,
+                                 dedup=args.dedup, compression=args.compress,
+                                 compress_min_savings=args.compress_min_savings / 100, client_paths=self._client_paths,
+                                 previous_outputs=self._all_outputs, updated=None if moved else affected)
+        self._all_outputs = all_outputs
+        logging.info(f"Updated {len(affected)} packages in {time.perf_counter() - start:.2f}s.")
+        return result
@@ -0,0 +1,49 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import sys
+
+# The commands import each other as top-level modules, just like when run from __main__.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("hurudist")))
+
+import pytest
+from ruamel.yaml import YAML
+
+@pytest.fixture
+def make_bundle():
+    """Returns a function that writes a bundle laid out the way the package command writes it,
+       from a dict mapping subpackage names to {asset_category: {asset_filename: (data, asset_dict)}}.
+       Nothing is indexed, so everything is loaded from the YAML.
+    """
+    def _make_bundle(path, packages):
+        yaml = YAML()
+        subpackages = []
+        for package_name, package in packages.items():
+            package_dict = {}
+            for asset_category, assets in package.items():
+                for asset_filename, (data, asset_dict) in assets.items():
+                    source = f"{asset_category}\\{asset_filename}"
+                    path.joinpath(package_name, asset_category).mkdir(parents=True, exist_ok=True)
+                    path.joinpath(package_name, asset_category, asset_filename).write_bytes(data)
+                    package_dict.setdefault(asset_category, {})[asset_filename] = dict(asset_dict, source=source,
+                                                                                       size=len(data))
+            with path.joinpath(package_name, "contents.yml").open("w") as stream:
+                yaml.dump(package_dict, stream)
+            subpackages.append({ "name": package_name, "source": f"{package_name}\\contents.yml" })
+        with path.joinpath("contents.yml").open("w") as stream:
+            yaml.dump({ "subpackages": subpackages }, stream)
+        return path
+    return _make_bundle
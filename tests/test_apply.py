@@ -0,0 +1,63 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import shutil
+
+from ruamel.yaml import YAML
+
+from _constants import *
+import apply
+import diff
+import merge
+
+def test_patch_keeps_subpackages(tmp_path, make_bundle):
+    old_path = make_bundle(tmp_path.joinpath("old"), {
+        "Age1": { "data": { "Age1.age": (b"age1", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) } },
+        "Age2": { "data": { "Age2.age": (b"age2", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) },
+                  "python": { "gone.py": (b"gone", {}) } },
+    })
+    new_path = make_bundle(tmp_path.joinpath("new"), {
+        "Age1": { "data": { "Age1.age": (b"age1 v2", {}) },
+                  "sfx": { "shared.ogg": (b"ogg", { "options": ["sound_stream"] }) } },
+        "Age2": { "data": { "Age2.age": (b"age2", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) } },
+        "Age3": { "data": { "Age3.age": (b"age3", {}) } },
+    })
+    patch_path = tmp_path.joinpath("patch")
+    assert diff.main(argparse.Namespace(old=old_path, new=new_path, destination=patch_path, jobs=1,
+                                        link_mode=LinkMode.copy))
+
+    database_path = tmp_path.joinpath("database")
+    shutil.copytree(old_path, database_path)
+    apply.apply_patch(database_path, patch_path, jobs=1)
+
+    # The contents files are updated where they are, rather than written next to them.
+    yaml = YAML(typ="safe")
+    assert sorted(i.name for i in database_path.iterdir() if i.is_file()) == \
+           ["Age3.yml", "contents.sqlite", "contents.yml"]
+    contents = yaml.load(database_path.joinpath("contents.yml"))
+    assert [i["name"] for i in contents["subpackages"]] == ["Age1", "Age2", "Age3"]
+
+    age1 = yaml.load(database_path.joinpath("Age1", "contents.yml"))
+    assert age1["sfx"]["shared.ogg"]["options"] == ["sound_stream"]
+    assert database_path.joinpath("Age1", "data", "Age1.age").read_bytes() == b"age1 v2"
+    age2 = yaml.load(database_path.joinpath("Age2", "contents.yml"))
+    assert "options" not in age2["sfx"]["shared.ogg"]
+    assert "python" not in age2
+    assert not database_path.joinpath("Age2", "python", "gone.py").exists()
+
+    database = merge.load_asset_db(database_path, jobs=1)
+    assert database[merge.asset_key("data", "Age3.age")].subpackages == ("Age3",)
+    assert merge.verify_db(database, database_path, jobs=1)
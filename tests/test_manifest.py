@@ -0,0 +1,49 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import hashlib
+
+from _constants import *
+import manifest
+
+def _run(source_path, dest_path, client_os=ClientOS.win, client_arch=ClientArch.amd64):
+    args = argparse.Namespace(source=source_path, destination=dest_path, client_os=client_os,
+                              client_arch=client_arch, jobs=1, link_mode=LinkMode.copy)
+    assert manifest.main(args)
+    return { i.stem: i.read_text().splitlines() for i in dest_path.glob("*.mfs") }
+
+def test_other_clients_artifacts_do_not_conflict(tmp_path, make_bundle):
+    source_path = make_bundle(tmp_path.joinpath("package"), {
+        "Client-win": { "artifacts": { "plClient": (b"win exe", { "arch": "amd64", "os": "win" }) } },
+        "Client-mac": { "artifacts": { "plClient": (b"mac app", { "arch": "amd64", "os": "mac" }) } },
+    })
+
+    for client_os, data in ((ClientOS.win, b"win exe"), (ClientOS.mac, b"mac app")):
+        manifests = _run(source_path, tmp_path.joinpath(str(client_os)), client_os=client_os)
+        entry, = manifests["External"]
+        assert entry.split(",")[2] == hashlib.md5(data).hexdigest()
+
+def test_uncompressed_assets_are_not_gzipped(tmp_path, make_bundle):
+    source_path = make_bundle(tmp_path.joinpath("package"), {
+        "Age1": { "data": { "Age1.age": (b"age1" * 64, { "compression": "none" }) } },
+    })
+
+    manifests = _run(source_path, tmp_path.joinpath("filesrv"))
+    client_path, download_path, *_, flags = manifests["Age1"][0].split(",")
+    assert download_path == client_path == "dat\\Age1.age"
+    assert int(flags) & int(ManifestFlags.zipped) == 0
+    assert tmp_path.joinpath("filesrv", "dat", "Age1.age").read_bytes() == b"age1" * 64
+    assert not tmp_path.joinpath("filesrv", "dat", "Age1.age.gz").exists()
@@ -0,0 +1,81 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+from ruamel.yaml import YAML
+
+import merge
+import _index
+
+def test_load_without_index(tmp_path, make_bundle):
+    source_path = make_bundle(tmp_path.joinpath("package"), {
+        "Age1": { "data": { "Age1.age": (b"age1", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) } },
+        "Age2": { "data": { "Age2.age": (b"age2", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) } },
+    })
+    assert not source_path.joinpath(_index.INDEX_FILENAME).exists()
+
+    database = merge.load_asset_db(source_path, jobs=1)
+    record = database[merge.asset_key("data", "Age1.age")]
+    assert record.subpackages == ("Age1",)
+    assert [i.source for i in record.versions] == ["Age1\\data\\Age1.age"]
+    record = database[merge.asset_key("sfx", "shared.ogg")]
+    assert record.subpackages == ("Age1", "Age2")
+    assert sorted(i.source for i in record.versions) == ["Age1\\sfx\\shared.ogg", "Age2\\sfx\\shared.ogg"]
+
+    assert merge.verify_db(database, source_path, jobs=1)
+    merge.reduce_db(database)
+    merge.save_db(database, source_path, tmp_path.joinpath("merged"))
+    contents = YAML(typ="safe").load(tmp_path.joinpath("merged", "contents.yml"))
+    assert sorted(contents["data"].keys()) == ["Age1.age", "Age2.age"]
+    assert tmp_path.joinpath("merged", "audio", "shared.ogg").read_bytes() == b"ogg"
+
+def test_merge_multiple_archs(tmp_path, make_bundle):
+    # What package --extra-client amd64 writes.
+    source_path = make_bundle(tmp_path.joinpath("package"), {
+        "Client": { "sdl": { "client.sdl": (b"sdl", {}) } },
+        "Client-i386": { "artifacts": { "UruExplorer.exe": (b"i386 exe", { "arch": "i386", "os": "win" }) } },
+        "Client-amd64": { "artifacts": { "UruExplorer.exe": (b"amd64 exe", { "arch": "amd64", "os": "win" }) } },
+    })
+
+    database = merge.load_asset_db(source_path, jobs=1)
+    merge.reduce_db(database)
+    assert len(database) == 3
+    merged_path = tmp_path.joinpath("merged")
+    merge.save_db(database, source_path, merged_path)
+
+    # Each architecture's artifacts keep their own copy.
+    yaml = YAML(typ="safe")
+    contents = yaml.load(merged_path.joinpath("contents.yml"))
+    assert sorted(i["name"] for i in contents["subpackages"]) == ["Client-amd64", "Client-i386", "Shared"]
+    for arch in ("i386", "amd64"):
+        package = yaml.load(merged_path.joinpath(f"Client-{arch}.yml"))
+        asset_dict = package["artifacts"]["UruExplorer.exe"]
+        assert asset_dict["arch"] == arch
+        assert merged_path.joinpath(*asset_dict["source"].split("\\")).read_bytes() == f"{arch} exe".encode()
+    assert "client.sdl" in yaml.load(merged_path.joinpath("Shared.yml"))["sdl"]
+
+    # The merged bundle loads back with the architectures still apart.
+    database = merge.load_asset_db(merged_path, jobs=1)
+    assert { key for key in database.keys() if key[0] == "artifacts" } == \
+           { merge.asset_key("artifacts", "UruExplorer.exe", arch) for arch in ("i386", "amd64") }
+
+def test_merge_single_arch_is_flat(tmp_path, make_bundle):
+    source_path = make_bundle(tmp_path.joinpath("package"), {
+        "Client": { "artifacts": { "UruExplorer.exe": (b"exe", { "arch": "i386", "os": "win" }) } },
+    })
+    database = merge.load_asset_db(source_path, jobs=1)
+    merge.reduce_db(database)
+    merge.save_db(database, source_path, tmp_path.joinpath("merged"))
+    contents = YAML(typ="safe").load(tmp_path.joinpath("merged", "contents.yml"))
+    assert contents["artifacts"]["UruExplorer.exe"]["source"] == "base\\UruExplorer.exe"
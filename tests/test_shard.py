@@ -0,0 +1,93 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from pathlib import Path
+import random
+
+import pytest
+
+import merge
+
+class _AgeInfo:
+    """Just enough of plAgeInfo to find the pages of an age."""
+
+    def __init__(self, name, num_pages):
+        self.name = name
+        self._num_pages = num_pages
+
+    def getNumPages(self):
+        return self._num_pages
+
+    def getPageFilename(self, i, version):
+        return f"{self.name}_District_Page{i}.prp"
+
+    def getNumCommonPages(self, version):
+        return 0
+
+def test_partition_ages():
+    pytest.importorskip("PyHSPlasma")
+    import package
+
+    rng = random.Random(24)
+    age_infos = [_AgeInfo(f"Age{i}", rng.randint(1, 8)) for i in range(40)]
+    sizes = { Path("dat", age_info.getPageFilename(i, None)): rng.choice((0, 1, 1000, rng.randint(1, 1 << 20)))
+              for age_info in age_infos for i in range(age_info.getNumPages()) }
+
+    def stat(path):
+        # Some pages are missing from the client.
+        size = sizes[path]
+        return os.stat_result((0,) * 6 + (size, 0, 0, 0)) if size else None
+
+    for shard_count in (1, 2, 3, 7, 40, 50):
+        shards = package.partition_ages(age_infos, Path("dat"), shard_count, stat=stat)
+        assert len(shards) == shard_count
+        names = [i.name for shard in shards for i in shard]
+        assert sorted(names) == sorted(i.name for i in age_infos)
+
+        # Every node must come up with the same split, however it happened to list the ages.
+        shuffled = list(age_infos)
+        rng.shuffle(shuffled)
+        for _ in range(3):
+            again = package.partition_ages(shuffled, Path("dat"), shard_count, stat=stat)
+            assert [[i.name for i in shard] for shard in again] == [[i.name for i in shard] for shard in shards]
+
+def _read_tree(path):
+    return { i.relative_to(path): i.read_bytes() for i in path.rglob("*") if i.is_file() }
+
+def test_merged_shards_match_single_build(tmp_path, make_bundle):
+    packages = {
+        "Client": { "sdl": { "client.sdl": (b"sdl", {}) }, "python": { "xKI.py": (b"ki", {}) } },
+        "Age1": { "data": { "Age1.age": (b"age1", {}) }, "sfx": { "shared.ogg": (b"ogg", { "options": ["sound_stream"] }) } },
+        "Age2": { "data": { "Age2.age": (b"age2", {}) }, "sfx": { "shared.ogg": (b"ogg", {}) } },
+        "Age3": { "data": { "Age3.age": (b"age3", {}) }, "python": { "xKI.py": (b"ki", {}) } },
+    }
+    single_path = make_bundle(tmp_path.joinpath("single"), packages)
+    # Only the first shard packages the client.
+    shard_paths = [make_bundle(tmp_path.joinpath("shards", "shard1"), { i: packages[i] for i in ("Client", "Age2") }),
+                   make_bundle(tmp_path.joinpath("shards", "shard2"), { i: packages[i] for i in ("Age3", "Age1") })]
+
+    database = merge.load_asset_db(single_path, jobs=1)
+    merge.reduce_db(database)
+    merge.save_db(database, single_path, tmp_path.joinpath("single-merged"))
+
+    sharded_path = tmp_path.joinpath("shards")
+    database = {}
+    for i in shard_paths:
+        merge.combine_db(database, merge.load_asset_db(i, jobs=1), i.relative_to(sharded_path))
+    merge.reduce_db(database)
+    merge.save_db(database, sharded_path, tmp_path.joinpath("sharded-merged"))
+
+    assert _read_tree(tmp_path.joinpath("sharded-merged")) == _read_tree(tmp_path.joinpath("single-merged"))
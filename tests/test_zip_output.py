@@ -0,0 +1,72 @@
+#    This file is part of HuruDist
+#
+#    HuruDist is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    HuruDist is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with HuruDist.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from pathlib import Path
+import zipfile
+
+import pytest
+
+import _utils
+
+def _write_zip(tmp_path, files):
+    with _utils.OutputManager(tmp_path.joinpath("package.zip")) as outfile:
+        for name, data in files.items():
+            source_path = tmp_path.joinpath(name)
+            source_path.write_bytes(data)
+            outfile.copy_file(source_path, Path("dat", name))
+    return zipfile.ZipFile(tmp_path.joinpath("package.zip"))
+
+@pytest.mark.parametrize("raw_append", [True, False])
+def test_members(tmp_path, monkeypatch, raw_append):
+    monkeypatch.setattr(_utils, "_ZIP_RAW_APPEND", raw_append and _utils._ZIP_RAW_APPEND)
+    monkeypatch.setattr(_utils, "_ZIP_MAX_PARALLEL_SIZE", 256 * 1024)
+    files = {
+        "small.prp": b"plasma page " * 1024,
+        "large.prp": b"large plasma page " * 32 * 1024,
+        "music.ogg": b"not really vorbis " * 1024,
+        "noise.prp": os.urandom(128 * 1024),
+    }
+    with _write_zip(tmp_path, files) as archive:
+        assert archive.testzip() is None
+        for name, data in files.items():
+            assert archive.read(f"dat/{name}") == data
+        infos = { i.filename: i for i in archive.infolist() }
+
+    # Everything that shrinks is deflated, no matter how big it is.
+    for name in ("small.prp", "large.prp"):
+        assert infos[f"dat/{name}"].compress_type == zipfile.ZIP_DEFLATED
+        assert infos[f"dat/{name}"].compress_size < len(files[name])
+    for name in ("music.ogg", "noise.prp"):
+        assert infos[f"dat/{name}"].compress_type == zipfile.ZIP_STORED
+
+def test_fallback(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(_utils, "_ZIP_RAW_APPEND", False)
+    _utils._log_zip_fallback.cache_clear()
+
+    def _append_zip_member(self, zinfo, compressed):
+        raise AssertionError("appended a member outside of zipfile")
+    monkeypatch.setattr(_utils.OutputManager, "_append_zip_member", _append_zip_member)
+
+    files = { "first.prp": b"plasma page " * 1024, "second.prp": b"another plasma page " * 1024 }
+    for i in range(2):
+        with _write_zip(tmp_path.joinpath(str(i)), files) as archive:
+            assert archive.testzip() is None
+            for name, data in files.items():
+                assert archive.read(f"dat/{name}") == data
+                assert archive.getinfo(f"dat/{name}").compress_type == zipfile.ZIP_DEFLATED
+
+    # Every archive is written the slow way, but that is only worth saying once.
+    assert sum("compressed one at a time" in i.getMessage() for i in caplog.records) == 1